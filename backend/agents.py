@@ -1,7 +1,13 @@
 import os
+import re
+import time
+import logging
 
 from typing import List, Literal, TypedDict
 import asyncio
+from contextlib import asynccontextmanager
+
+import numpy as np
 
 from pydantic import BaseModel
 import instructor
@@ -19,8 +25,18 @@ from langchain_groq import ChatGroq
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, StateGraph
 
-from retrieval import VectorSearch
+from retrieval import EmeddingModel, QueryBatcher, VectorSearch
+from query_log import QueryLog
+from answer_cache import SemanticAnswerCache
+from context_packer import ContextPacker, build_token_counter
+from history import history_fields, history_tokens, history_window, sync_history
+from classifiers import build_classifier
 from prompt_manager import PromptManager
+from scheduler import UpstreamScheduler
+from checkpoint_store import IF_LATEST, CheckpointConflict
+from metrics import CACHE_REQUESTS, DECISIONS, LLM_TOKENS_PER_SECOND, LLM_TTFT_SECONDS, log_state, timed_node
+
+logger = logging.getLogger(__name__)
 
 # Prompt Manager
 prompt_manager = PromptManager(
@@ -37,20 +53,35 @@ class ChatStream(TypedDict):
     status: Literal["streaming", "completed"]
     token: str
     citations: List[str]
+    cached: bool
 
 class GraphState(TypedDict):
     user_query: BaseMessage
     is_data_valid: bool
     is_safe: bool
     messages: List[BaseMessage]
+    # Rendered prompt fragment and token count per entry of messages, appended once per turn.
+    history: List[str]
+    history_token_counts: List[int]
+    history_tokens: int
     full_history: List[BaseMessage]
-    router_result: RouterRoutes
+    # RouterRoutes.model_dump(): checkpoints only hold plain values, never pydantic models.
+    router_result: dict
     is_query_valid: bool
     improved_query: BaseMessage
+    query_embedding: np.ndarray
+    retrieval_filters: dict
     retrieval_result: List[dict]
     chat_stream: ChatStream
     num_compressions: int = 0
 
+async def improved_query_embedding(state: GraphState, vector_search: VectorSearch):
+    query = state["improved_query"].content
+    # Routing may already have embedded the raw query; reuse it when the context builder left the text unchanged.
+    if state.get("query_embedding") is not None and query == state["user_query"].content:
+        return state["query_embedding"]
+    return await vector_search.aembed_query(query)
+
 # Data Validator
 class DataValidator:
     def __init__(self, prompt_manager: PromptManager):
@@ -60,7 +91,7 @@ class DataValidator:
         self.max_tokens = config.get('max_tokens', 4000)
 
     async def is_valid(self, state: GraphState):
-        print("data valid", state)
+        log_state(logger, "data valid", state)
         user_prompt = state['user_query'].content
         character_estimate = len(user_prompt) * self.character_multiplier
         word_estimate = len(user_prompt.split()) * self.word_multiplier
@@ -70,47 +101,95 @@ class DataValidator:
 
 # Safety Agent
 class SafetyAgent:
-    def __init__(self, prompt_manager: PromptManager):
+    def __init__(self, prompt_manager: PromptManager, scheduler: UpstreamScheduler, vector_search: VectorSearch = None):
         config = prompt_manager.get_model_config('safety_agent')
         self.model_id = config.get('model_id', 'meta-llama/llama-prompt-guard-2-86m')
         self.temperature = config.get('temperature', 0)
         self.max_completion_tokens = config.get('max_completion_tokens', 1)
         self.top_p = config.get('top_p', 1)
         self.safety_threshold = config.get('safety_threshold', 0.8)
-        self.model = AsyncGroq()
+        # Local classifier labels are 'safe' / 'unsafe'; answers below the confidence bar go to the remote model.
+        self.vector_search = vector_search
+        self.classifier = build_classifier(config, vector_search.embed_model if vector_search else None)
+        self.classifier_min_confidence = config.get('classifier_min_confidence', 0.9)
+        self.scheduler = scheduler
+        self.model = AsyncGroq(http_client=scheduler.http_client)
 
     async def is_safe(self, state: GraphState):
         user_prompt = state['user_query'].content
-        response = await self.model.chat.completions.create(
-            model=self.model_id,
-            messages=[
-                {
-                    "role": "user",
-                    "content": user_prompt
-                }
-            ],
-            temperature=self.temperature,
-            max_completion_tokens=self.max_completion_tokens,
-            top_p=self.top_p
-        )
+        if self.classifier is not None:
+            try:
+                label, confidence = await self._classify_locally(state, user_prompt)
+            except Exception:
+                # The local path is an optimisation: an embedding or runtime error falls back to the remote model.
+                logger.warning("Local safety classifier failed, using the remote model", exc_info=True)
+                DECISIONS.inc(agent="safety", path="local_error")
+                label, confidence = None, 0.0
+            if confidence >= self.classifier_min_confidence:
+                DECISIONS.inc(agent="safety", path="local")
+                state["is_safe"] = label == "safe"
+                return state
+        DECISIONS.inc(agent="safety", path="remote")
+        async with self.scheduler.slot(self.model_id):
+            response = await self.model.chat.completions.create(
+                model=self.model_id,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": user_prompt
+                    }
+                ],
+                temperature=self.temperature,
+                max_completion_tokens=self.max_completion_tokens,
+                top_p=self.top_p
+            )
         state["is_safe"] = float(response.choices[0].message.content) < self.safety_threshold
-        print("safety", state)
+        log_state(logger, "safety", state)
         return state
 
+    async def _classify_locally(self, state: GraphState, user_prompt: str):
+        embedding = None
+        if self.classifier.needs_embedding:
+            embedding = state["query_embedding"] = await self.vector_search.aembed_query(user_prompt)
+        return await self.classifier.classify(user_prompt, embedding)
+
 # Router Agent
 class RouterAgent:
-    def __init__(self, prompt_manager: PromptManager):
+    def __init__(self, prompt_manager: PromptManager, scheduler: UpstreamScheduler, vector_search: VectorSearch = None):
         self.prompt_manager = prompt_manager
         config = prompt_manager.get_model_config('router_agent')
         self.model_id = config.get('model_id', 'gemma2-9b-it')
         self.temperature = config.get('temperature', 0)
-        self.model = instructor.from_groq(AsyncGroq())
+        # Local classifier labels are the route names; answers below the confidence bar go to the remote model.
+        self.vector_search = vector_search
+        self.classifier = build_classifier(config, vector_search.embed_model if vector_search else None)
+        self.classifier_min_confidence = config.get('classifier_min_confidence', 0.7)
+        # A near neighbour in the Slack index is direct evidence the question is answerable by retrieval.
+        self.corpus_signal = config.get('corpus_signal', True)
+        self.corpus_match_similarity = config.get('corpus_match_similarity', 0.75)
+        self.history_max_tokens = config.get('history_max_tokens', 1500)
+        self.scheduler = scheduler
+        self.model = instructor.from_groq(AsyncGroq(http_client=scheduler.http_client))
 
     async def route(self, state: GraphState):
-        print("router in", state)
+        log_state(logger, "router in", state)
         user_query = state['user_query'].content
         old_messages = state.get("messages", [])
-        history = self._build_history(old_messages)
+        # Follow-ups need the history to route, which only the remote router sees.
+        if self.classifier is not None and not (old_messages and FOLLOW_UP_PATTERN.search(user_query)):
+            try:
+                routed = await self._route_locally(state, user_query)
+            except Exception:
+                logger.warning("Local router classifier failed, using the remote model", exc_info=True)
+                DECISIONS.inc(agent="router", path="local_error")
+                routed = None
+            if routed is not None:
+                DECISIONS.inc(agent="router", path="local")
+                state["router_result"] = routed.model_dump()
+                state["is_query_valid"] = routed.route != "off_topic"
+                return state
+        DECISIONS.inc(agent="router", path="remote")
+        history = history_window(state, self.history_max_tokens)
         
         system_prompt = self.prompt_manager.get_prompt('router_agent', 'system_prompt')
         user_prompt_template = self.prompt_manager.get_prompt('router_agent', 'user_prompt_template')
@@ -120,41 +199,53 @@ class RouterAgent:
             user_query=user_query
         )
         
-        response = await self.model.chat.completions.create(
-            model=self.model_id,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            response_model=RouterRoutes,
-            max_retries=3,
-            temperature=self.temperature
-        )
+        async with self.scheduler.slot(self.model_id):
+            response = await self.model.chat.completions.create(
+                model=self.model_id,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                response_model=RouterRoutes,
+                max_retries=self.scheduler.retrying(self.model_id),
+                temperature=self.temperature
+            )
         
-        state["router_result"] = response
+        state["router_result"] = response.model_dump()
         state["is_query_valid"] = response.route != "off_topic"
-        print("router out", state)
+        log_state(logger, "router out", state)
         return state
-    
-    def _build_history(self, messages):
-        history = ""
-        if not messages:
-            return history
-        for message in messages:
-            if isinstance(message, HumanMessage):
-                history += f"<human>{message.content}</human>\n"
-            elif isinstance(message, AIMessage):
-                history += f"<assistant>{message.content}</assistant>\n"
-            else:
-                history += f"<previous-conversation>{message.content}</previous-conversation>\n"
-        return history
+
+    async def _route_locally(self, state: GraphState, user_query: str):
+        embedding = None
+        if self.classifier.needs_embedding:
+            embedding = state["query_embedding"] = await self.vector_search.aembed_query(user_query)
+        label, confidence = await self.classifier.classify(user_query, embedding)
+        corpus_match = False
+        if self.corpus_signal and embedding is not None:
+            await self.vector_search.aensure_loaded()
+            similarity = self.vector_search.nearest_similarity(embedding)
+            corpus_match = similarity is not None and similarity >= self.corpus_match_similarity
+        if corpus_match:
+            # Off-topic by exemplars but close to the corpus is contradictory: leave it to the LLM router.
+            if label == "off_topic":
+                return None
+            return RouterRoutes(route="retrieval", confidence="high")
+        if confidence < self.classifier_min_confidence:
+            return None
+        return RouterRoutes(route=label, confidence="high" if confidence >= 0.9 else "medium")
 
 # QA Agent 
 class ChatAgent:
-    def __init__(self, prompt_manager: PromptManager):
+    def __init__(self, prompt_manager: PromptManager, scheduler: UpstreamScheduler, vector_search: VectorSearch = None):
         self.prompt_manager = prompt_manager
         config = prompt_manager.get_model_config('chat_agent')
         self.model_id = config.get('model_id', 'moonshotai/kimi-k2-instruct')
+        self.vector_search = vector_search
+        self.answer_cache = None
+        if vector_search is not None and config.get('answer_cache', True):
+            self.answer_cache = SemanticAnswerCache.from_config(config)
+        self.context_packer = ContextPacker.from_config(config, agent='chat')
         
         system_prompt = prompt_manager.get_prompt('chat_agent', 'system_prompt')
         user_prompt = prompt_manager.get_prompt('chat_agent', 'user_prompt_template')
@@ -163,39 +254,71 @@ class ChatAgent:
             ("system", system_prompt), 
             ("human", user_prompt)
         ])
-        self.model = ChatGroq(model=self.model_id)
+        self.scheduler = scheduler
+        self.model = ChatGroq(model=self.model_id, http_async_client=scheduler.http_client)
 
     async def generate(self, state: GraphState):
-        print("chat in", state)
+        log_state(logger, "chat in", state)
         context = ''
         citations = [] 
-        if state['router_result'].route == 'retrieval':
-            context, citations = self._parse_retreived_documents(state['retrieval_result'])
+        if state['router_result']['route'] == 'retrieval':
+            # Citations follow the packed passages, so dropped duplicates are not cited.
+            documents = self.context_packer.pack(state['improved_query'].content, state['retrieval_result'])
+            context, citations = self._parse_retreived_documents(documents)
+
+        cache_key = None
+        if self.answer_cache is not None:
+            state["query_embedding"] = await improved_query_embedding(state, self.vector_search)
+            cache_key = (self.vector_search.version, state['router_result']['route'], tuple(citations))
+            cached = self.answer_cache.lookup(state["query_embedding"], cache_key)
+            CACHE_REQUESTS.inc(cache="answer", result="hit" if cached is not None else "miss")
+            if cached is not None:
+                state["chat_stream"] = ChatStream(status="completed", token=cached['answer'], citations=citations, cached=True)
+                self._append_messages(state, cached['answer'])
+                return state
         
         generate_chain = self.chat_prompt_template | self.model
         chat_stream = ChatStream(
             status="streaming",
             token="",
-            citations=citations
+            citations=citations,
+            cached=False
         )
         state["chat_stream"] = chat_stream
         full_response = ""
+        start = time.perf_counter()
+        first_chunk_at = None
+        num_chunks = 0
         
-        async for chunk in generate_chain.astream({
-            "context": context,
-            "user_query": state['improved_query'].content
-        }):
-            if chunk.content:
-                full_response += chunk.content
-                state["chat_stream"]["token"] = chunk.content
+        async with self.scheduler.slot(self.model_id, priority='interactive'):
+            async for chunk in generate_chain.astream({
+                "context": context,
+                "user_query": state['improved_query'].content
+            }):
+                if chunk.content:
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                        LLM_TTFT_SECONDS.observe(first_chunk_at - start, model=self.model_id)
+                    num_chunks += 1
+                    full_response += chunk.content
+                    state["chat_stream"]["token"] = chunk.content
         
+        if first_chunk_at is not None and num_chunks > 1:
+            # Groq streams roughly one token per chunk, so chunks/sec stands in for tokens/sec.
+            LLM_TOKENS_PER_SECOND.observe((num_chunks - 1) / max(time.perf_counter() - first_chunk_at, 1e-6), model=self.model_id)
         state["chat_stream"]["status"] = "completed"
+        if cache_key is not None and full_response:
+            self.answer_cache.store(state["query_embedding"], cache_key, full_response, citations)
+        self._append_messages(state, full_response)
+        log_state(logger, "chat out", state)
+        return state
+
+    def _append_messages(self, state: GraphState, response: str):
         messages = state.get("messages", [])
         messages.append(state["user_query"])
-        messages.append(AIMessage(content=full_response))
+        messages.append(AIMessage(content=response))
         state["messages"] = messages
-        print("chat out", state)
-        return state
+        sync_history(state, self.context_packer.count_tokens)
     
     def _parse_retreived_documents(self, documents):
         text = ''
@@ -206,11 +329,21 @@ class ChatAgent:
         return text, indices
 
 # Context Builder Agent
+# Pronouns and follow-up phrasing that only make sense against earlier turns.
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|she|above|previous|previously|earlier|same|again|also|"
+    r"instead|else|more|another|other|one|ones|last|first|second|example|why|what about|how about|and)\b",
+    re.IGNORECASE
+)
+
 class ContextBuilderAgent:
-    def __init__(self, prompt_manager: PromptManager):
+    def __init__(self, prompt_manager: PromptManager, scheduler: UpstreamScheduler):
         self.prompt_manager = prompt_manager
         config = prompt_manager.get_model_config('context_builder')
         self.model_id = config.get('model_id', 'moonshotai/kimi-k2-instruct')
+        self.fast_path = config.get('fast_path', True)
+        self.self_contained_min_words = config.get('self_contained_min_words', 6)
+        self.history_max_tokens = config.get('history_max_tokens', 1500)
         
         system_prompt = prompt_manager.get_prompt('context_builder', 'system_prompt')
         user_prompt = prompt_manager.get_prompt('context_builder', 'user_prompt_template')
@@ -219,39 +352,44 @@ class ContextBuilderAgent:
             ("system", system_prompt), 
             ("human", user_prompt)
         ])
-        self.model = ChatGroq(model=self.model_id)
+        self.scheduler = scheduler
+        self.model = ChatGroq(model=self.model_id, http_async_client=scheduler.http_client)
 
     async def generate(self, state: GraphState):
         old_messages = state.get("messages", [])
-        history = self._build_history(old_messages)
+        user_query = state["user_query"].content
+        if self.fast_path and self._is_self_contained(user_query, old_messages):
+            # Nothing to resolve against, so the rewrite would only echo the query back.
+            DECISIONS.inc(agent="context_builder", path="fast_path")
+            state["improved_query"] = HumanMessage(content=user_query)
+            return state
+        DECISIONS.inc(agent="context_builder", path="rewrite")
+        history = history_window(state, self.history_max_tokens)
         paraphrase_chain = self.chat_prompt_template | self.model
-        result = await paraphrase_chain.ainvoke({
-            "history": history, 
-            "user_query": state["user_query"].content
-        })
+        async with self.scheduler.slot(self.model_id):
+            result = await paraphrase_chain.ainvoke({
+                "history": history, 
+                "user_query": user_query
+            })
         state["improved_query"] = HumanMessage(content=result.content)
-        print("context builder out", state)
+        log_state(logger, "context builder out", state)
         return state
 
-    def _build_history(self, messages):
-        history = ""
+    def _is_self_contained(self, user_query, messages):
         if not messages:
-            return history
-        for message in messages:
-            if isinstance(message, HumanMessage):
-                history += f"<human>{message.content}</human>\n"
-            elif isinstance(message, AIMessage):
-                history += f"<assistant>{message.content}</assistant>\n"
-            else:
-                history += f"<previous-conversation>{message.content}</previous-conversation>\n"
-        return history
+            return True
+        return len(user_query.split()) >= self.self_contained_min_words and not FOLLOW_UP_PATTERN.search(user_query)
 
 # Memory Manager
 class MemoryManagerAgent:
-    def __init__(self, prompt_manager: PromptManager):
+    def __init__(self, prompt_manager: PromptManager, scheduler: UpstreamScheduler):
         self.prompt_manager = prompt_manager
         config = prompt_manager.get_model_config('memory_manager')
         self.model_id = config.get('model_id', 'moonshotai/kimi-k2-instruct')
+        self.max_full_history = config.get('max_full_history', 200)
+        self.compress_after_tokens = config.get('compress_after_tokens', 2000)
+        self.keep_recent_messages = config.get('keep_recent_messages', 4)
+        self.count_tokens = build_token_counter(config.get('tokenizer', 'auto'))
         
         system_prompt = prompt_manager.get_prompt('memory_manager', 'system_prompt')
         user_prompt = prompt_manager.get_prompt('memory_manager', 'user_prompt_template')
@@ -260,43 +398,231 @@ class MemoryManagerAgent:
             ("system", system_prompt), 
             ("human", user_prompt)
         ])
-        self.model = ChatGroq(model=self.model_id)
+        self.scheduler = scheduler
+        self.model = ChatGroq(model=self.model_id, http_async_client=scheduler.http_client)
 
-    async def generate(self, state: GraphState):
-        old_messages = state.get("messages", [])
-        history = self._build_history(old_messages)
+    def needs_compression(self, state: GraphState):
+        messages = state.get("messages", [])
+        turns = len(messages) - (1 if messages and isinstance(messages[0], SystemMessage) else 0)
+        return turns > self.keep_recent_messages and history_tokens(state, self.count_tokens) > self.compress_after_tokens
+
+    async def compress(self, state: GraphState):
+        messages = state.get("messages", [])
+        has_summary = bool(messages) and isinstance(messages[0], SystemMessage)
+        summary = messages[0].content if has_summary else ""
+        turns = messages[1:] if has_summary else messages
+        # Rolling summary: only the messages leaving the window are sent, folded into the previous summary.
+        evicted, recent = turns[:-self.keep_recent_messages], turns[-self.keep_recent_messages:]
+        history = state.get("history") or []
+        if len(history) == len(messages):
+            evicted_history = "".join(history[len(messages) - len(turns):len(messages) - len(recent)])
+        else:
+            evicted_history = history_window({"messages": evicted})
         summarization_chain = self.chat_prompt_template | self.model
-        result = await summarization_chain.ainvoke({"history": history})
-        
-        full_history = state.get("full_history", [])
-        full_history.extend(state.get("messages", []))
-        state["full_history"] = full_history
-        state["messages"] = [SystemMessage(content=result.content)]
-        num_compressions = state.get("num_compressions", 0) + 1
-        state["num_compressions"] = num_compressions
-        return state
+        async with self.scheduler.slot(self.model_id, priority='background'):
+            result = await summarization_chain.ainvoke({
+                "summary": summary,
+                "history": evicted_history
+            })
+        full_history = state.get("full_history", []) + evicted
+        messages = [SystemMessage(content=result.content)] + recent
+        return {
+            "messages": messages,
+            **history_fields(messages, self.count_tokens),
+            "full_history": full_history[-self.max_full_history:],
+            "num_compressions": state.get("num_compressions", 0) + 1
+        }
 
-    def _build_history(self, messages):
-        history = ""
-        if not messages:
-            return history
-        for message in messages:
-            if isinstance(message, HumanMessage):
-                history += f"<human>{message.content}</human>\n"
-            elif isinstance(message, AIMessage):
-                history += f"<assistant>{message.content}</assistant>\n"
-            else:
-                history += f"<previous-conversation>{message.content}</previous-conversation>\n"
-        return history
+class MemoryCompressionQueue:
+    """Debounced background compression of thread histories, written back to the checkpoint after the response."""
+    def __init__(self, graph, memory_agent: MemoryManagerAgent, debounce_seconds: float = 2.0,
+                 max_concurrency: int = 2, as_node: str = "chat_agent"):
+        self.graph = graph
+        self.memory_agent = memory_agent
+        self.debounce_seconds = debounce_seconds
+        self.as_node = as_node
+        self._due = {}
+        self._running = set()
+        self._tasks = set()
+        self._thread_locks = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._wakeup = asyncio.Event()
+
+    @classmethod
+    def from_config(cls, graph, memory_agent: MemoryManagerAgent, config: dict):
+        return cls(
+            graph,
+            memory_agent,
+            debounce_seconds=config.get('debounce_seconds', 2.0),
+            max_concurrency=config.get('max_concurrency', 2)
+        )
+
+    @asynccontextmanager
+    async def thread_lock(self, thread_id: str):
+        # Turns and compression both write the thread's checkpoint; entries are dropped once nobody holds or waits on them.
+        entry = self._thread_locks.setdefault(thread_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._thread_locks[thread_id]
+
+    def schedule(self, thread_id: str):
+        # Rapid follow-ups push the deadline back, so a burst of turns costs one compression.
+        self._due[thread_id] = time.monotonic() + self.debounce_seconds
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            for thread_id, due in list(self._due.items()):
+                if due <= now and thread_id not in self._running:
+                    del self._due[thread_id]
+                    self._running.add(thread_id)
+                    task = asyncio.create_task(self._compress(thread_id))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+            waiting = [due for thread_id, due in self._due.items() if thread_id not in self._running]
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(min(waiting) - now, 0) if waiting else None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _compress(self, thread_id: str):
+        config = {"configurable": {"thread_id": thread_id}}
+        try:
+            snapshot = await self.graph.aget_state(config)
+            messages = snapshot.values.get("messages", [])
+            if not self.memory_agent.needs_compression(snapshot.values):
+                return
+            async with self._semaphore:
+                update = await self.memory_agent.compress(snapshot.values)
+            # The summary is built unlocked; only the re-read and write are serialized with the thread's turns.
+            async with self.thread_lock(thread_id):
+                latest = await self.graph.aget_state(config)
+                current = latest.values.get("messages", [])
+                # A turn that finished meanwhile appended to the same prefix; anything else rewrote history, so drop this result.
+                if current[:len(messages)] != messages:
+                    return
+                update["messages"] += current[len(messages):]
+                sync_history(update, self.memory_agent.count_tokens)
+                # The lock only covers this process: the write fails if another worker committed a turn since the re-read.
+                await self.graph.aupdate_state({"configurable": {**latest.config["configurable"], IF_LATEST: True}},
+                                               update, as_node=self.as_node)
+            DECISIONS.inc(agent="memory_manager", path="compressed")
+        except CheckpointConflict:
+            DECISIONS.inc(agent="memory_manager", path="conflict")
+            logger.info("Memory compression for thread %s lost a race with another turn, dropped", thread_id)
+        except Exception:
+            logger.exception("Memory compression failed for thread %s", thread_id)
+        finally:
+            self._running.discard(thread_id)
+            self._wakeup.set()
+
+    async def aclose(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+# Preflight Agent
+class PreflightAgent:
+    def __init__(self, prompt_manager: PromptManager, safety_agent: SafetyAgent, router_agent: RouterAgent,
+                 context_builder_agent: ContextBuilderAgent):
+        config = prompt_manager.get_model_config('preflight')
+        self.speculative_context_build = config.get('speculative_context_build', True)
+        self.safety_agent = safety_agent
+        self.router_agent = router_agent
+        self.context_builder_agent = context_builder_agent
+
+    async def run(self, state: GraphState):
+        # Each check works on its own copy of the state so concurrent writes cannot interleave.
+        safety_task = asyncio.create_task(timed_node("safety_agent", self.safety_agent.is_safe)(dict(state)))
+        router_task = asyncio.create_task(timed_node("router_agent", self.router_agent.route)(dict(state)))
+        context_task = None
+        if self.speculative_context_build:
+            context_task = asyncio.create_task(timed_node("context_builder_agent", self.context_builder_agent.generate)(dict(state)))
+        tasks = [task for task in (safety_task, router_task, context_task) if task]
+
+        try:
+            pending = {safety_task, router_task}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if safety_task in done:
+                    checked = safety_task.result()
+                    state["is_safe"] = checked["is_safe"]
+                    if checked.get("query_embedding") is not None:
+                        state["query_embedding"] = checked["query_embedding"]
+                    if not state["is_safe"]:
+                        return state
+                if router_task in done:
+                    routed = router_task.result()
+                    state["router_result"] = routed["router_result"]
+                    state["is_query_valid"] = routed["is_query_valid"]
+                    if routed.get("query_embedding") is not None:
+                        state["query_embedding"] = routed["query_embedding"]
+                    if not state["is_query_valid"]:
+                        return state
+
+            if context_task is None:
+                context_task = asyncio.create_task(timed_node("context_builder_agent", self.context_builder_agent.generate)(dict(state)))
+                tasks.append(context_task)
+            state["improved_query"] = (await context_task)["improved_query"]
+            return state
+        finally:
+            # Speculative work is discarded as soon as safety or routing says to stop.
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
 
 class RetrievalAgent:
-    def __init__(self):
-        self.vector_search = VectorSearch()
+    def __init__(self, prompt_manager: PromptManager):
+        config = prompt_manager.get_model_config('retrieval_agent')
+        self.top_k = config.get('top_k', 3)
+        db_path = config.get('db_path', './retrieval')
+        serving_mode = config.get('serving_mode', True)
+        self.vector_search = VectorSearch(
+            db_path=db_path,
+            data_dir=None if serving_mode else '../data/clojurians/2019',
+            lazy_load=serving_mode,
+            read_only=serving_mode,
+            mmap_index=config.get('mmap_index', serving_mode),
+            reload_interval=config.get('reload_interval_seconds', 5) if serving_mode else None,
+            embed_model=EmeddingModel.from_config(config, cache_dir=db_path),
+            index_type=config.get('index_type', 'auto'),
+            index_params=config.get('index_params'),
+            ef_search=config.get('ef_search'),
+            nprobe=config.get('nprobe'),
+            retrieval_mode=config.get('retrieval_mode', 'vector'),
+            rrf_k=config.get('rrf_k', 60),
+            fusion_candidates=config.get('fusion_candidates', 20),
+            chunk_words=config.get('chunk_words', 256),
+            chunk_overlap_words=config.get('chunk_overlap_words', 64),
+            chunk_overfetch=config.get('chunk_overfetch', 4),
+            max_chunks_per_result=config.get('max_chunks_per_result', 2),
+            query_log=QueryLog.from_config(config) if config.get('query_log', True) else None
+        )
+        # Concurrent /chat requests retrieving within the same few milliseconds share one index search.
+        self.batcher = None
+        if config.get('micro_batching', True):
+            self.batcher = QueryBatcher(
+                self.vector_search,
+                window_seconds=config.get('batch_window_ms', 3) / 1000,
+                max_batch_size=config.get('max_batch_size', 32)
+            )
 
     async def retrieve(self, state: GraphState):
-        state["retrieval_result"] = await asyncio.to_thread(
-            self.vector_search.query,
-            state["improved_query"].content
+        query = state["improved_query"].content
+        state["query_embedding"] = await improved_query_embedding(state, self.vector_search)
+        search = self.batcher.query if self.batcher is not None else self.vector_search.aquery
+        state["retrieval_result"] = await search(
+            query,
+            k=self.top_k,
+            filters=state.get("retrieval_filters"),
+            embedding=state["query_embedding"]
         )
         return state
 
@@ -313,6 +639,11 @@ def is_safe_steer(state: GraphState):
     else:
         return "router_agent"
 
+def preflight_steer(state: GraphState):
+    if not state["is_safe"] or not state["is_query_valid"]:
+        return "end"
+    return retrieval_non_retrieval_steer(state)
+
 def category_router_steer(state: GraphState):
     if not state["is_query_valid"]:
         return "end"
@@ -320,102 +651,106 @@ def category_router_steer(state: GraphState):
         return "context_builder_agent"
     
 def retrieval_non_retrieval_steer(state: GraphState):
-    if state["router_result"].route == "non_retrieval":
+    if state["router_result"]["route"] == "non_retrieval":
         return "non_retrieval"
     else:
         return "retrieval"
 
-def memory_management_steer(state: GraphState, max_messages=16):
-    if not len(state.get("messages", [])) > max_messages:
-        return "end"
-    else:
-        return "memory_management_agent"
-
-def build_graph():
+def build_graph(checkpointer=None, scheduler: UpstreamScheduler = None):
     # Initialize prompt manager
     prompt_mgr = PromptManager()
     
     # Graph Building
-    checkpoint_save_dir = "checkpoint"
-    # checkpoint_file_name = "chat_history.sqlite"
     DATA_VALIDATOR = "data_validator"
     SAFETY_AGENT = "safety_agent"
     ROUTER_AGENT = "router_agent"
     CHAT_AGENT = "chat_agent"
     CONTEXT_BUILDER_AGENT = "context_builder_agent"
-    MEMORY_MANAGEMENT_AGENT = "memory_management_agent"
     RETRIEVAL_AGENT = "retrieval_agent"
+    PREFLIGHT_AGENT = "preflight_agent"
+    parallel_preflight = prompt_mgr.get_model_config('preflight').get('parallel', True)
+
+    # One scheduler for every agent, so models shared between agents also share their limits and connection pool.
+    scheduler = scheduler or UpstreamScheduler.from_config(prompt_mgr.get_model_config('scheduler'))
 
     # Initialize agents with prompt manager
     data_validator = DataValidator(prompt_mgr)
-    safety_agent = SafetyAgent(prompt_mgr)
-    router_agent = RouterAgent(prompt_mgr)
-    chat_agent = ChatAgent(prompt_mgr)
-    context_builder_agent = ContextBuilderAgent(prompt_mgr)
-    memory_management_agent = MemoryManagerAgent(prompt_mgr)
-    retrieval_agent = RetrievalAgent()
+    retrieval_agent = RetrievalAgent(prompt_mgr)
+    safety_agent = SafetyAgent(prompt_mgr, scheduler, retrieval_agent.vector_search)
+    router_agent = RouterAgent(prompt_mgr, scheduler, retrieval_agent.vector_search)
+    chat_agent = ChatAgent(prompt_mgr, scheduler, retrieval_agent.vector_search)
+    context_builder_agent = ContextBuilderAgent(prompt_mgr, scheduler)
+    preflight_agent = PreflightAgent(prompt_mgr, safety_agent, router_agent, context_builder_agent)
 
     graph = StateGraph(GraphState)
-    graph.add_node(DATA_VALIDATOR, data_validator.is_valid)
-    graph.add_node(SAFETY_AGENT, safety_agent.is_safe)
-    graph.add_node(ROUTER_AGENT, router_agent.route)
-    graph.add_node(CHAT_AGENT, chat_agent.generate)
-    graph.add_node(CONTEXT_BUILDER_AGENT, context_builder_agent.generate)
-    graph.add_node(MEMORY_MANAGEMENT_AGENT, memory_management_agent.generate)
-    graph.add_node(RETRIEVAL_AGENT, retrieval_agent.retrieve)
-
-    graph.add_conditional_edges(
-        DATA_VALIDATOR,
-        is_data_valid_steer,
-        {
-            "end": END,
-            "safety_agent": SAFETY_AGENT
-        }
-    )
-    graph.add_conditional_edges(
-        SAFETY_AGENT,
-        is_safe_steer,
-        {
-            "end": END,
-            "router_agent": ROUTER_AGENT
-        }
-    )
-
-    graph.add_conditional_edges(
-        ROUTER_AGENT,
-        category_router_steer,
-        {
-            "end": END,
-            "context_builder_agent": CONTEXT_BUILDER_AGENT
-        }
-    )
-    graph.add_conditional_edges(
-        CONTEXT_BUILDER_AGENT,
-        retrieval_non_retrieval_steer,
-        {
-            "non_retrieval": CHAT_AGENT,
-            "retrieval": RETRIEVAL_AGENT
-        }
-    )
+    graph.add_node(DATA_VALIDATOR, timed_node(DATA_VALIDATOR, data_validator.is_valid))
+    graph.add_node(CHAT_AGENT, timed_node(CHAT_AGENT, chat_agent.generate))
+    graph.add_node(RETRIEVAL_AGENT, timed_node(RETRIEVAL_AGENT, retrieval_agent.retrieve))
+
+    if parallel_preflight:
+        # Fan-out/fan-in: safety, routing and a speculative query rewrite run concurrently in one node.
+        graph.add_node(PREFLIGHT_AGENT, timed_node(PREFLIGHT_AGENT, preflight_agent.run))
+        graph.add_conditional_edges(
+            DATA_VALIDATOR,
+            is_data_valid_steer,
+            {
+                "end": END,
+                "safety_agent": PREFLIGHT_AGENT
+            }
+        )
+        graph.add_conditional_edges(
+            PREFLIGHT_AGENT,
+            preflight_steer,
+            {
+                "end": END,
+                "non_retrieval": CHAT_AGENT,
+                "retrieval": RETRIEVAL_AGENT
+            }
+        )
+    else:
+        graph.add_node(SAFETY_AGENT, timed_node(SAFETY_AGENT, safety_agent.is_safe))
+        graph.add_node(ROUTER_AGENT, timed_node(ROUTER_AGENT, router_agent.route))
+        graph.add_node(CONTEXT_BUILDER_AGENT, timed_node(CONTEXT_BUILDER_AGENT, context_builder_agent.generate))
+        graph.add_conditional_edges(
+            DATA_VALIDATOR,
+            is_data_valid_steer,
+            {
+                "end": END,
+                "safety_agent": SAFETY_AGENT
+            }
+        )
+        graph.add_conditional_edges(
+            SAFETY_AGENT,
+            is_safe_steer,
+            {
+                "end": END,
+                "router_agent": ROUTER_AGENT
+            }
+        )
+        graph.add_conditional_edges(
+            ROUTER_AGENT,
+            category_router_steer,
+            {
+                "end": END,
+                "context_builder_agent": CONTEXT_BUILDER_AGENT
+            }
+        )
+        graph.add_conditional_edges(
+            CONTEXT_BUILDER_AGENT,
+            retrieval_non_retrieval_steer,
+            {
+                "non_retrieval": CHAT_AGENT,
+                "retrieval": RETRIEVAL_AGENT
+            }
+        )
 
     graph.add_edge(RETRIEVAL_AGENT, CHAT_AGENT)
-    graph.add_conditional_edges(
-        CHAT_AGENT, 
-        memory_management_steer,
-        {
-            "end": END,
-            "memory_management_agent": MEMORY_MANAGEMENT_AGENT
-        }
-    )
-    graph.add_edge(MEMORY_MANAGEMENT_AGENT, END)
+    # History compression runs out of band (MemoryCompressionQueue), so the request ends with the answer.
+    graph.add_edge(CHAT_AGENT, END)
     graph.set_entry_point(DATA_VALIDATOR)
 
-    os.makedirs(checkpoint_save_dir, exist_ok=True)
-    # sql_conn = await aiosqlite.connect(os.path.join(checkpoint_save_dir, checkpoint_file_name))
-    # checkpointer = AsyncSqliteSaver(sql_conn)
-    checkpointer = MemorySaver()
-
-    app = graph.compile(checkpointer=checkpointer)
+    # The API passes the persistent SQLite checkpointer (checkpoint_store.open_checkpointer); scripts fall back to memory.
+    app = graph.compile(checkpointer=checkpointer or MemorySaver())
     return app
 
 def draw_graph():
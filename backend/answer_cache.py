@@ -0,0 +1,66 @@
+import time
+
+import numpy as np
+
+class SemanticAnswerCache:
+    """In-process cache of final answers, matched on cosine similarity of the improved-query embedding."""
+    def __init__(self, max_entries: int = 2048, ttl_seconds: float = 3600, similarity_threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.vectors = None
+        self.entries = [None] * max_entries
+        # -inf marks a free slot, so argmin picks free slots before the least recently used entry.
+        self.last_used = np.full(max_entries, -np.inf)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(
+            max_entries=config.get('answer_cache_max_entries', 2048),
+            ttl_seconds=config.get('answer_cache_ttl_seconds', 3600),
+            similarity_threshold=config.get('answer_cache_similarity_threshold', 0.95)
+        )
+
+    def _normalize(self, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def _drop(self, slot):
+        self.entries[slot] = None
+        self.last_used[slot] = -np.inf
+
+    def lookup(self, embedding, key):
+        occupied = np.flatnonzero(self.last_used > -np.inf)
+        if self.vectors is None or not len(occupied):
+            self.misses += 1
+            return None
+        now = time.time()
+        similarities = self.vectors[occupied] @ self._normalize(embedding)
+        for position in np.argsort(-similarities):
+            if similarities[position] < self.similarity_threshold:
+                break
+            slot = occupied[position]
+            entry = self.entries[slot]
+            if now - entry['created_at'] > self.ttl_seconds:
+                self._drop(slot)
+                continue
+            # The key pins the index version and retrieved doc ids: a similar query over a changed corpus is a miss.
+            if entry['key'] != key:
+                continue
+            self.last_used[slot] = now
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def store(self, embedding, key, answer, citations):
+        embedding = self._normalize(embedding)
+        if self.vectors is None:
+            self.vectors = np.zeros((self.max_entries, len(embedding)), dtype=np.float32)
+        slot = int(np.argmin(self.last_used))
+        now = time.time()
+        self.vectors[slot] = embedding
+        self.entries[slot] = {'key': key, 'answer': answer, 'citations': list(citations), 'created_at': now}
+        self.last_used[slot] = now
@@ -1,13 +1,26 @@
+from typing import Optional
 from pydantic import BaseModel
+import re
 import json
+import uuid
+import asyncio
+import logging
+import contextvars
+from contextlib import aclosing
 
 from langchain_core.messages import HumanMessage
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
-from agents import build_graph
+from agents import MemoryCompressionQueue, MemoryManagerAgent, build_graph
+from checkpoint_store import open_checkpointer
+from prompt_manager import PromptManager
+from scheduler import AdmissionController, Overloaded, UpstreamScheduler
+from metrics import CHAT_REQUESTS, configure_logging, finish_trace, render_metrics, start_trace
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Sherlock", version = "0.1.0")
 
@@ -18,24 +31,126 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class RetrievalFilters(BaseModel):
+    team_domain: Optional[str] = None
+    channel_name: Optional[str] = None
+
 class ChatRequest(BaseModel):
     user_query: str
     thread_id: str = "default"
+    filters: Optional[RetrievalFilters] = None
 
 graph = None
+checkpointer = None
+scheduler = None
+admission = None
+memory_queue = None
+eviction_task = None
+memory_task = None
+trace_sample_rate = 0.0
+disconnect_poll_interval = 0.5
 @app.on_event("startup")
 async def startup():
-    global graph
-    graph = build_graph()
-    print("Graph initialized")
+    global graph, checkpointer, scheduler, admission, memory_queue, eviction_task, memory_task
+    global trace_sample_rate, disconnect_poll_interval
+    observability_config = PromptManager().get_model_config('observability')
+    configure_logging(observability_config)
+    trace_sample_rate = observability_config.get('trace_sample_rate', 0.0)
+    api_config = PromptManager().get_model_config('api')
+    disconnect_poll_interval = api_config.get('disconnect_poll_interval_seconds', 0.5)
+    admission = AdmissionController.from_config(api_config)
+    scheduler = UpstreamScheduler.from_config(PromptManager().get_model_config('scheduler'))
+    checkpointer_config = PromptManager().get_model_config('checkpointer')
+    checkpointer = await open_checkpointer(checkpointer_config)
+    eviction_task = asyncio.create_task(
+        checkpointer.run_eviction(checkpointer_config.get('eviction_interval_seconds', 600))
+    )
+    graph = build_graph(checkpointer, scheduler)
+    memory_queue = MemoryCompressionQueue.from_config(
+        graph, MemoryManagerAgent(PromptManager(), scheduler), PromptManager().get_model_config('memory_manager')
+    )
+    memory_task = asyncio.create_task(memory_queue.run())
+    logger.info("Graph initialized")
+
+@app.on_event("shutdown")
+async def shutdown():
+    if eviction_task:
+        eviction_task.cancel()
+    if memory_task:
+        memory_task.cancel()
+        await memory_queue.aclose()
+    if checkpointer:
+        await checkpointer.conn.close()
+    if scheduler:
+        await scheduler.aclose()
 
 @app.get("/")
 async def healthcheck():
     return {"status": "running"}
 
+@app.get("/metrics")
+async def metrics():
+    # Per-process: with several uvicorn workers each scrape sees the worker that answered it.
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+class ClientDisconnected(Exception):
+    pass
+
+async def until_disconnected(http_request: Request, events, poll_interval: float):
+    """Re-yield events, cancelling the pending step (and with it the running graph) once the client goes away."""
+    iterator = events.__aiter__()
+    # Every step runs in one shared context so context variables set inside the graph stream survive between steps.
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    next_check = loop.time() + poll_interval
+    step = None
+    try:
+        while True:
+            step = loop.create_task(iterator.__anext__(), context=context)
+            # Poll on a clock rather than per event: a node can run for seconds without emitting anything.
+            while True:
+                done, _ = await asyncio.wait({step}, timeout=max(next_check - loop.time(), 0))
+                if loop.time() >= next_check:
+                    if await http_request.is_disconnected():
+                        raise ClientDisconnected()
+                    next_check = loop.time() + poll_interval
+                if done:
+                    break
+            try:
+                event = step.result()
+            except StopAsyncIteration:
+                return
+            yield event
+    finally:
+        if step is not None and not step.done():
+            step.cancel()
+            await asyncio.wait({step})
+        await iterator.aclose()
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """Hands the admission slot back when the response ends, even if the client left before the body was iterated."""
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
 @app.post("/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
+    try:
+        await admission.acquire()
+    except Overloaded as e:
+        CHAT_REQUESTS.inc(outcome="shed")
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": "1"})
+    release = admission.releaser()
+
     async def generate():
+        trace = start_trace(request_id=uuid.uuid4().hex, thread_id=request.thread_id)
+        outcome = "answered"
         try:
             user_query = HumanMessage(content=request.user_query)
             initial_state = {
@@ -45,75 +160,116 @@ async def chat(request: ChatRequest):
                 "router_result": None,
                 "is_query_valid": True,
                 "improved_query": None,
+                "query_embedding": None,
+                "retrieval_filters": request.filters.model_dump(exclude_none=True) if request.filters else {},
                 "retrieval_result": [],
                 "chat_stream": None,
             }
-            config = {"configurable":{"thread_id":"default"}}
+            config = {"configurable":{"thread_id":request.thread_id}}
             got_response = False
             is_streaming = False
 
             is_streaming = False
             citations = []
 
-            async for event in graph.astream_events(initial_state, config, version="v2"):
-                event_type = event["event"]
+            events = graph.astream_events(initial_state, config, version="v2")
+            # Held for the whole turn so background compression never writes over a turn in progress.
+            async with memory_queue.thread_lock(request.thread_id), \
+                    aclosing(until_disconnected(http_request, events, disconnect_poll_interval)) as stream:
+                async for event in stream:
+                    event_type = event["event"]
                 
-                if event_type == "on_chain_end":
-                    metadata = event.get("metadata", {})
-                    node_name = metadata.get("langgraph_node") if isinstance(metadata, dict) else None
+                    if event_type == "on_chain_end":
+                        metadata = event.get("metadata", {})
+                        node_name = metadata.get("langgraph_node") if isinstance(metadata, dict) else None
                     
-                    event_name = event.get("name", "")
+                        event_name = event.get("name", "")
                     
-                    if node_name == "data_validator" or event_name == "data_validator":
-                        output = event.get("data", {}).get("output", {})
-                        if isinstance(output, dict) and not output.get("is_data_valid", True):
-                            yield f'data: {json.dumps({"done": False, "token": "I\'m sorry, but your query is too long. Please try with a shorter message."})}\n\n'
-                            yield f'data: {json.dumps({"done": True, "citations": []})}\n\n'
-                            return
+                        if node_name == "data_validator" or event_name == "data_validator":
+                            output = event.get("data", {}).get("output", {})
+                            if isinstance(output, dict) and not output.get("is_data_valid", True):
+                                outcome = "too_long"
+                                yield f'data: {json.dumps({"done": False, "token": "I\'m sorry, but your query is too long. Please try with a shorter message."})}\n\n'
+                                yield f'data: {json.dumps({"done": True, "citations": []})}\n\n'
+                                return
+                    
+                        elif node_name == "safety_agent" or event_name == "safety_agent":
+                            output = event.get("data", {}).get("output", {})
+                            if isinstance(output, dict) and not output.get("is_safe", True):
+                                outcome = "unsafe"
+                                yield f'data: {json.dumps({"done": False, "token": "I\'m sorry, but I can\'t answer this query."})}\n\n'
+                                yield f'data: {json.dumps({"done": True, "citations": []})}\n\n'
+                                return
                     
-                    elif node_name == "safety_agent" or event_name == "safety_agent":
-                        output = event.get("data", {}).get("output", {})
-                        if isinstance(output, dict) and not output.get("is_safe", True):
-                            yield f'data: {json.dumps({"done": False, "token": "I\'m sorry, but I can\'t answer this query."})}\n\n'
-                            yield f'data: {json.dumps({"done": True, "citations": []})}\n\n'
-                            return
+                        elif node_name == "router_agent" or event_name == "router_agent":
+                            output = event.get("data", {}).get("output", {})
+                            if isinstance(output, dict):
+                                router_result = output.get("router_result")
+                                if isinstance(router_result, dict) and router_result.get("route") == "off_topic":
+                                    outcome = "off_topic"
+                                    yield f'data: {json.dumps({"done": False, "token": "I\'m sorry, but I can only answer queries related to Python programming."})}\n\n'
+                                    yield f'data: {json.dumps({"done": True, "citations": []})}\n\n'
+                                    return
                     
-                    elif node_name == "router_agent" or event_name == "router_agent":
-                        output = event.get("data", {}).get("output", {})
-                        if isinstance(output, dict):
-                            router_result = output.get("router_result")
-                            if router_result and hasattr(router_result, 'route') and router_result.route == "off_topic":
+                        elif node_name == "preflight_agent" or event_name == "preflight_agent":
+                            output = event.get("data", {}).get("output", {})
+                            if isinstance(output, dict) and not output.get("is_safe", True):
+                                outcome = "unsafe"
+                                yield f'data: {json.dumps({"done": False, "token": "I\'m sorry, but I can\'t answer this query."})}\n\n'
+                                yield f'data: {json.dumps({"done": True, "citations": []})}\n\n'
+                                return
+                            if isinstance(output, dict) and not output.get("is_query_valid", True):
+                                outcome = "off_topic"
                                 yield f'data: {json.dumps({"done": False, "token": "I\'m sorry, but I can only answer queries related to Python programming."})}\n\n'
                                 yield f'data: {json.dumps({"done": True, "citations": []})}\n\n'
                                 return
-                    
-                    elif node_name == "chat_agent" or event_name == "chat_agent":
-                        output = event.get("data", {}).get("output", {})
-                        if isinstance(output, dict):
-                            chat_stream = output.get("chat_stream", {})
-                            if isinstance(chat_stream, dict):
-                                citations = chat_stream.get("citations", [])
-                            else:
-                                citations = []
-                            yield f'data: {json.dumps({"done": True, "citations": citations})}\n\n'
-                            is_streaming = False
-                    elif event_name == "LangGraph":
-                        break
+
+                        elif node_name == "chat_agent" or event_name == "chat_agent":
+                            output = event.get("data", {}).get("output", {})
+                            if isinstance(output, dict):
+                                chat_stream = output.get("chat_stream", {})
+                                if isinstance(chat_stream, dict):
+                                    citations = chat_stream.get("citations", [])
+                                    if chat_stream.get("cached"):
+                                        outcome = "cached"
+                                        # Answer-cache hit: no model ran, so replay the stored answer as stream tokens.
+                                        for token in re.findall(r"\S+\s*", chat_stream.get("token", "")):
+                                            yield f'data: {json.dumps({"done": False, "token": token})}\n\n'
+                                else:
+                                    citations = []
+                                yield f'data: {json.dumps({"done": True, "citations": citations})}\n\n'
+                                is_streaming = False
+                        elif event_name == "LangGraph":
+                            break
                 
-                elif event_type == "on_chain_start":
-                    if event.get("metadata", {}).get("langgraph_node") == "chat_agent":
-                        is_streaming = True
+                    elif event_type == "on_chain_start":
+                        if event.get("metadata", {}).get("langgraph_node") == "chat_agent":
+                            is_streaming = True
                 
-                elif event_type == "on_chat_model_stream" and is_streaming:
-                    chunk = event.get("data", {}).get("chunk")
-                    if chunk and hasattr(chunk, "content") and chunk.content:
-                        yield f'data: {json.dumps({"done": False, "token": chunk.content})}\n\n'
+                    elif event_type == "on_chat_model_stream" and is_streaming:
+                        chunk = event.get("data", {}).get("chunk")
+                        if chunk and hasattr(chunk, "content") and chunk.content:
+                            yield f'data: {json.dumps({"done": False, "token": chunk.content})}\n\n'
+        except ClientDisconnected:
+            outcome = "cancelled"
+        except (asyncio.CancelledError, GeneratorExit):
+            # The server cancelled the response or closed the stream mid-answer; the graph is torn down by until_disconnected.
+            outcome = "cancelled"
+            raise
         except Exception as e:
-            print(f"Error:\n: {str(e)}")
+            outcome = "error"
+            logger.exception("Chat request failed")
             yield f'data: {json.dumps({"error": str(e)})}\n\n'
+        finally:
+            release()
+            if outcome in ("answered", "cached"):
+                memory_queue.schedule(request.thread_id)
+            CHAT_REQUESTS.inc(outcome=outcome)
+            finish_trace(trace, trace_sample_rate, outcome=outcome)
 
-    return StreamingResponse(
+    return AdmittedStreamingResponse(
         generate(),
+        release,
         media_type="text/event-stream",
         headers={"X-Accel-Buffering": "no"}
     )
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import zlib
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import faiss
+
+from retrieval import VectorSearch, parse_text
+
+CONFIGS = {
+    'flat': {'index_type': 'flat'},
+    'hnsw_flat': {'index_type': 'hnsw_flat'},
+    'hnsw_flat_ef128': {'index_type': 'hnsw_flat', 'ef_search': 128},
+    'hnsw_sq8': {'index_type': 'hnsw_sq8'},
+    'ivf_pq': {'index_type': 'ivf_pq'},
+    'ivf_pq_nprobe64': {'index_type': 'ivf_pq', 'nprobe': 64},
+}
+
+VOCABULARY = (
+    "clojure core async channel repl leiningen deps spec macro atom reagent ring compojure datomic jdbc "
+    "transducer vector map keyword namespace require exception stacktrace jvm classpath uberjar cider emacs "
+    "vscode calva shadow cljs figwheel test fixture protocol record multimethod lazy seq reduce"
+).split()
+
+class FakeEmbeddingModel:
+    """Deterministic, network-free embeddings clustered by the leading topic token of the text."""
+    def __init__(self, dim: int = 768, num_topics: int = 256, seed: int = 0):
+        self.model_id = 'fake'
+        self.dim = dim
+        self.centroids = np.random.default_rng(seed).standard_normal((num_topics, dim)).astype(np.float32)
+
+    def _embed_one(self, text):
+        digest = zlib.crc32(text.encode('utf-8'))
+        topic = int(text.split(' ', 1)[0][len('topic'):]) if text.startswith('topic') else digest
+        noise = np.random.default_rng(digest).standard_normal(self.dim).astype(np.float32)
+        return self.centroids[topic % len(self.centroids)] + 0.5 * noise
+
+    def embed(self, text, progress_path=None, keep_in_memory: bool = True):
+        return np.stack([self._embed_one(item) for item in text]) if text else np.zeros((0, self.dim), dtype=np.float32)
+
+    async def aembed(self, text, keep_in_memory: bool = True):
+        return self.embed(text)
+
+def make_corpus(num_docs, num_topics=256, seed=0):
+    rng = np.random.default_rng(seed)
+    topics = rng.integers(0, num_topics, num_docs)
+    words = rng.integers(0, len(VOCABULARY), (num_docs, 24))
+    documents = []
+    for row in range(num_docs):
+        text = f"topic{topics[row]} " + " ".join(VOCABULARY[w] for w in words[row]) + f" ident{row}\n"
+        documents.append({
+            'id': str(row),
+            'text': text,
+            'metadata': {'team_domain': 'bench', 'channel_name': f"channel{topics[row] % 8}"}
+        })
+    return documents
+
+def make_queries(num_queries, num_topics=256, seed=1):
+    rng = np.random.default_rng(seed)
+    return [
+        f"topic{rng.integers(0, num_topics)} " + " ".join(VOCABULARY[w] for w in rng.integers(0, len(VOCABULARY), 8))
+        for _ in range(num_queries)
+    ]
+
+def resident_memory_bytes():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def exact_neighbors(vectors, queries, k):
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    return index.search(queries, k)[1]
+
+def run_benchmark(num_docs, config_name, queries, k=10, concurrency=8, embed_model=None):
+    config = CONFIGS[config_name]
+    embed_model = embed_model or FakeEmbeddingModel()
+    documents = make_corpus(num_docs)
+
+    with tempfile.TemporaryDirectory() as db_path:
+        rss_before = resident_memory_bytes()
+        vector_search = VectorSearch(
+            db_path=db_path,
+            data_dir=None,
+            embed_model=embed_model,
+            index_type=config['index_type'],
+            ef_search=config.get('ef_search'),
+            nprobe=config.get('nprobe')
+        )
+        start = time.perf_counter()
+        vector_search.index(documents)
+        build_seconds = time.perf_counter() - start
+        rss_after = resident_memory_bytes()
+
+        query_embeddings = embed_model.embed(queries)
+        vectors = embed_model.embed([parse_text(document) for document in documents])
+        expected = exact_neighbors(vectors, query_embeddings, k)
+
+        latencies = []
+        hits = 0
+        for query, embedding, truth in zip(queries, query_embeddings, expected):
+            start = time.perf_counter()
+            rows, _, _ = vector_search._vector_candidates(embedding.reshape(1, -1), k)
+            latencies.append(time.perf_counter() - start)
+            hits += len(set(rows.tolist()) & set(truth.tolist()))
+
+        # End-to-end queries (fake embedding, search, document lookup) from concurrent threads.
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(lambda query: vector_search.query(query, k=k, mode='vector'), queries))
+        qps = len(queries) / (time.perf_counter() - start)
+
+        # The same queries as one query_batch call: a single N x d search plus array lookups.
+        start = time.perf_counter()
+        vector_search.query_batch(queries, k=k, mode='vector')
+        batch_qps = len(queries) / (time.perf_counter() - start)
+
+        latencies_ms = np.array(latencies) * 1000
+        return {
+            'config': config_name,
+            'index_type': vector_search.index_params['index_type'],
+            'num_docs': num_docs,
+            'k': k,
+            'build_seconds': round(build_seconds, 4),
+            'index_bytes': len(faiss.serialize_index(vector_search.indexes)),
+            'rss_delta_bytes': rss_after - rss_before if rss_before is not None else None,
+            'p50_ms': round(float(np.percentile(latencies_ms, 50)), 4),
+            'p95_ms': round(float(np.percentile(latencies_ms, 95)), 4),
+            'p99_ms': round(float(np.percentile(latencies_ms, 99)), 4),
+            'qps': round(qps, 1),
+            'batch_qps': round(batch_qps, 1),
+            'concurrency': concurrency,
+            f'recall@{k}': round(hits / (len(queries) * k), 4),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency / throughput / recall benchmark for VectorSearch configurations.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument('--num-queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', default='artifacts/benchmark_retrieval')
+    args = parser.parse_args()
+
+    queries = make_queries(args.num_queries)
+    rows = []
+    for num_docs in args.sizes:
+        for config_name in args.configs:
+            result = run_benchmark(num_docs, config_name, queries, k=args.k, concurrency=args.concurrency)
+            print(result)
+            rows.append(result)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output + '.json', 'w') as f:
+        json.dump(rows, f, indent=2)
+    pd.DataFrame(rows).to_csv(args.output + '.csv', index=False)
+    print(f"Wrote {len(rows)} results to {args.output}.json / .csv")
+
+if __name__ == "__main__":
+    main()
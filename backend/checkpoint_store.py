@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+import aiosqlite
+from langgraph.checkpoint.base import get_checkpoint_metadata
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+logger = logging.getLogger(__name__)
+
+# Set in a write's configurable, next to the checkpoint_id it was computed from, to make the write a compare-and-set.
+IF_LATEST = "__if_latest"
+
+class CheckpointConflict(Exception):
+    pass
+
+class BoundedSqliteSaver(AsyncSqliteSaver):
+    """SQLite checkpointer that evicts idle threads and keeps only the newest checkpoints of each thread."""
+    def __init__(self, conn: aiosqlite.Connection, ttl_seconds: float = 7 * 24 * 3600,
+                 max_checkpoints_per_thread: int = 20, **kwargs):
+        super().__init__(conn, **kwargs)
+        self.ttl_seconds = ttl_seconds
+        self.max_checkpoints_per_thread = max_checkpoints_per_thread
+        self._activity_ready = False
+
+    async def setup(self):
+        await super().setup()
+        if self._activity_ready:
+            return
+        async with self.lock:
+            await self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS thread_activity (thread_id TEXT PRIMARY KEY, updated_at REAL NOT NULL)"
+            )
+            await self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS thread_activity_updated_at ON thread_activity (updated_at)"
+            )
+            await self.conn.commit()
+            self._activity_ready = True
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        if config["configurable"].get(IF_LATEST):
+            next_config = await self._aput_if_latest(config, checkpoint, metadata)
+        else:
+            next_config = await super().aput(config, checkpoint, metadata, new_versions)
+        async with self.lock:
+            await self.conn.execute(
+                "INSERT INTO thread_activity (thread_id, updated_at) VALUES (?, ?) "
+                "ON CONFLICT(thread_id) DO UPDATE SET updated_at = excluded.updated_at",
+                (str(config["configurable"]["thread_id"]), time.time())
+            )
+            await self.conn.commit()
+        return next_config
+
+    async def _aput_if_latest(self, config, checkpoint, metadata):
+        await self.setup()
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        parent_id = config["configurable"].get("checkpoint_id")
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        serialized_metadata = json.dumps(get_checkpoint_metadata(config, metadata), ensure_ascii=False).encode("utf-8", "ignore")
+        # One statement, so the check and the insert are atomic across every worker sharing the file.
+        async with self.lock:
+            cursor = await self.conn.execute(
+                "INSERT INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata) "
+                "SELECT ?, ?, ?, ?, ?, ?, ? WHERE (SELECT MAX(checkpoint_id) FROM checkpoints "
+                "WHERE thread_id = ? AND checkpoint_ns = ?) IS ?",
+                (thread_id, checkpoint_ns, checkpoint["id"], parent_id, type_, serialized_checkpoint, serialized_metadata,
+                 thread_id, checkpoint_ns, parent_id)
+            )
+            await self.conn.commit()
+        if not cursor.rowcount:
+            raise CheckpointConflict(f"Thread {thread_id} moved past checkpoint {parent_id}")
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    async def evict(self):
+        await self.setup()
+        cutoff = time.time() - self.ttl_seconds
+        async with self.lock:
+            cursor = await self.conn.execute("SELECT thread_id FROM thread_activity WHERE updated_at < ?", (cutoff,))
+            expired = [row[0] for row in await cursor.fetchall()]
+            for start in range(0, len(expired), 500):
+                chunk = expired[start:start+500]
+                placeholders = ",".join("?" * len(chunk))
+                for table in ("checkpoints", "writes", "thread_activity"):
+                    await self.conn.execute(f"DELETE FROM {table} WHERE thread_id IN ({placeholders})", chunk)
+
+            # Checkpoint ids are time-ordered, so everything past the newest N of a thread is history we never resume from.
+            cursor = await self.conn.execute(
+                "DELETE FROM checkpoints WHERE rowid IN ("
+                "SELECT rowid FROM (SELECT rowid, ROW_NUMBER() OVER ("
+                "PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC) AS position FROM checkpoints) "
+                "WHERE position > ?)",
+                (self.max_checkpoints_per_thread,)
+            )
+            pruned = cursor.rowcount
+            await self.conn.execute(
+                "DELETE FROM writes WHERE NOT EXISTS (SELECT 1 FROM checkpoints c WHERE c.thread_id = writes.thread_id "
+                "AND c.checkpoint_ns = writes.checkpoint_ns AND c.checkpoint_id = writes.checkpoint_id)"
+            )
+            await self.conn.commit()
+        return len(expired), pruned
+
+    async def run_eviction(self, interval_seconds: float = 600):
+        while True:
+            try:
+                expired, pruned = await self.evict()
+                if expired or pruned:
+                    logger.info("Checkpoint eviction: %d expired threads, %d old checkpoints removed", expired, pruned)
+            except aiosqlite.OperationalError as e:
+                # Another worker holds the write lock; try again next round.
+                logger.warning("Checkpoint eviction skipped: %s", e)
+            await asyncio.sleep(interval_seconds)
+
+async def open_checkpointer(config: dict):
+    path = config.get('path', 'checkpoint/chat_history.sqlite')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = await aiosqlite.connect(path, timeout=config.get('busy_timeout_seconds', 30))
+    # WAL lets every uvicorn worker read while one writes; the busy timeout serializes concurrent writers.
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    checkpointer = BoundedSqliteSaver(
+        conn,
+        ttl_seconds=config.get('thread_ttl_hours', 168) * 3600,
+        max_checkpoints_per_thread=config.get('max_checkpoints_per_thread', 20)
+    )
+    await checkpointer.setup()
+    return checkpointer
@@ -0,0 +1,97 @@
+import asyncio
+
+import numpy as np
+
+CLASSIFIER_BACKENDS = ('remote', 'embedding', 'onnx')
+
+def softmax(scores):
+    scores = np.asarray(scores, dtype=np.float32)
+    exp = np.exp(scores - scores.max())
+    return exp / exp.sum()
+
+class EmbeddingCentroidClassifier:
+    """Nearest-centroid classifier over query embeddings, with centroids built from labelled exemplar queries."""
+    needs_embedding = True
+
+    def __init__(self, embed_model, exemplars: dict, temperature: float = 0.05):
+        self.embed_model = embed_model
+        self.exemplars = exemplars
+        self.temperature = temperature
+        self.labels = list(exemplars)
+        self.centroids = None
+        self._lock = asyncio.Lock()
+
+    async def _load_centroids(self):
+        async with self._lock:
+            if self.centroids is not None:
+                return
+            centroids = []
+            for label in self.labels:
+                embeddings = np.array(await self.embed_model.aembed(self.exemplars[label]), dtype=np.float32)
+                embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+                centroid = embeddings.mean(axis=0)
+                centroids.append(centroid / np.linalg.norm(centroid))
+            self.centroids = np.stack(centroids).astype(np.float32)
+
+    async def classify(self, text, embedding=None):
+        if self.centroids is None:
+            await self._load_centroids()
+        if embedding is None:
+            embedding = (await self.embed_model.aembed([text]))[0]
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        similarities = self.centroids @ (embedding / max(float(np.linalg.norm(embedding)), 1e-12))
+        probabilities = softmax(similarities / self.temperature)
+        top = int(np.argmax(probabilities))
+        return self.labels[top], float(probabilities[top])
+
+class OnnxClassifier:
+    """Sequence classifier exported to ONNX (e.g. a quantized prompt-guard model), run on CPU in a worker thread."""
+    needs_embedding = False
+
+    def __init__(self, model_path: str, tokenizer_path: str, labels: list, max_length: int = 512, num_threads: int = 1):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError("The 'onnx' classifier backend requires the onnxruntime and tokenizers packages") from e
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length)
+        self.labels = labels
+
+    def _predict(self, text):
+        encoding = self.tokenizer.encode(text)
+        inputs = {
+            'input_ids': np.array([encoding.ids], dtype=np.int64),
+            'attention_mask': np.array([encoding.attention_mask], dtype=np.int64),
+            'token_type_ids': np.array([encoding.type_ids], dtype=np.int64),
+        }
+        logits = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0][0]
+        probabilities = softmax(logits)
+        top = int(np.argmax(probabilities))
+        return self.labels[top], float(probabilities[top])
+
+    async def classify(self, text, embedding=None):
+        return await asyncio.to_thread(self._predict, text)
+
+def build_classifier(config: dict, embed_model=None):
+    backend = config.get('classifier', 'remote')
+    if backend not in CLASSIFIER_BACKENDS:
+        raise ValueError(f"Unknown classifier backend '{backend}', expected one of {CLASSIFIER_BACKENDS}")
+    if backend == 'embedding':
+        return EmbeddingCentroidClassifier(
+            embed_model,
+            config['classifier_exemplars'],
+            temperature=config.get('classifier_temperature', 0.05)
+        )
+    if backend == 'onnx':
+        return OnnxClassifier(
+            config['classifier_model_path'],
+            config['classifier_tokenizer_path'],
+            config['classifier_labels'],
+            max_length=config.get('classifier_max_length', 512)
+        )
+    return None
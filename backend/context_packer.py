@@ -0,0 +1,146 @@
+import re
+import math
+from collections import Counter
+
+from lexical import tokenize
+from metrics import CONTEXT_DOCUMENTS, CONTEXT_TOKENS, current_trace
+
+TOKENIZERS = ('auto', 'tiktoken', 'heuristic')
+# Slack messages are lines; long messages are further split after sentence punctuation.
+SENTENCE_PATTERN = re.compile(r'\n+|(?<=[.!?])\s+(?=[A-Z`<@])')
+ESTIMATE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text):
+    # Words plus punctuation marks: within a few percent of BPE counts on chat-style English and code.
+    return len(ESTIMATE_PATTERN.findall(text))
+
+def build_token_counter(name: str = 'auto'):
+    if name not in TOKENIZERS:
+        raise ValueError(f"Unknown tokenizer '{name}', expected one of {TOKENIZERS}")
+    if name == 'heuristic':
+        return estimate_tokens
+    try:
+        import tiktoken
+    except ImportError as e:
+        if name == 'tiktoken':
+            raise ImportError("The 'tiktoken' tokenizer requires the tiktoken package") from e
+        return estimate_tokens
+    encoding = tiktoken.get_encoding('cl100k_base')
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+def shingles(tokens, size=3):
+    if len(tokens) < size:
+        return {tuple(tokens)}
+    return {tuple(tokens[position:position+size]) for position in range(len(tokens) - size + 1)}
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+class ContextPacker:
+    """Fits retrieved passages into a token budget: drops near-duplicates, then trims to the query-relevant sentences."""
+    def __init__(self, budget_tokens: int = 3000, duplicate_threshold: float = 0.8, tokenizer: str = 'auto',
+                 agent: str = 'chat'):
+        self.budget_tokens = budget_tokens
+        self.duplicate_threshold = duplicate_threshold
+        self.count_tokens = build_token_counter(tokenizer)
+        self.agent = agent
+
+    @classmethod
+    def from_config(cls, config: dict, agent: str):
+        return cls(
+            budget_tokens=config.get('context_budget_tokens', 3000),
+            duplicate_threshold=config.get('context_duplicate_threshold', 0.8),
+            tokenizer=config.get('context_tokenizer', 'auto'),
+            agent=agent
+        )
+
+    def _split(self, text):
+        return [sentence.strip() for sentence in SENTENCE_PATTERN.split(text) if sentence and sentence.strip()]
+
+    def _deduplicate(self, documents):
+        kept, kept_shingles = [], []
+        for document in documents:
+            document_shingles = shingles(tokenize(document['text']))
+            if any(jaccard(document_shingles, other) >= self.duplicate_threshold for other in kept_shingles):
+                continue
+            kept.append(document)
+            kept_shingles.append(document_shingles)
+        return kept
+
+    def _allocate(self, sizes):
+        # Water-filling: small passages keep everything, and what they leave over is shared by the larger ones.
+        shares = [0] * len(sizes)
+        remaining = self.budget_tokens
+        for position, index in enumerate(sorted(range(len(sizes)), key=lambda index: sizes[index])):
+            shares[index] = min(sizes[index], remaining // (len(sizes) - position))
+            remaining -= shares[index]
+        return shares
+
+    def _trim(self, sentences, sentence_tokens, share, query_terms, idf):
+        scores = [
+            sum(idf.get(term, 0.0) for term in query_terms.intersection(tokenize(sentence))) for sentence in sentences
+        ]
+        ranked = sorted((position for position in range(len(sentences)) if scores[position] > 0), key=lambda position: -scores[position])
+        # Nothing matches the query terms: keep the opening of the thread, which usually states the question.
+        ranked = ranked or range(len(sentences))
+        chosen, used = set(), 0
+        for position in ranked:
+            if used + sentence_tokens[position] <= share:
+                chosen.add(position)
+                used += sentence_tokens[position]
+        parts, previous = [], -1
+        for position in sorted(chosen):
+            if parts and position != previous + 1:
+                parts.append("...")
+            parts.append(sentences[position])
+            previous = position
+        return "\n".join(parts), used
+
+    def pack(self, query, documents):
+        unique = self._deduplicate(documents)
+        # Messages quoted or repeated across threads only need to appear once.
+        seen = set()
+        split = []
+        for document in unique:
+            sentences = []
+            for sentence in self._split(document['text']):
+                normalized = " ".join(sentence.lower().split())
+                if normalized not in seen:
+                    seen.add(normalized)
+                    sentences.append(sentence)
+            split.append(sentences)
+        sentence_tokens = [[self.count_tokens(sentence) for sentence in sentences] for sentences in split]
+        sizes = [sum(tokens) for tokens in sentence_tokens]
+
+        document_frequency = Counter(term for sentences in split for sentence in sentences for term in set(tokenize(sentence)))
+        num_sentences = max(sum(map(len, split)), 1)
+        idf = {term: math.log(1 + num_sentences / count) for term, count in document_frequency.items()}
+        query_terms = set(tokenize(query))
+
+        packed = []
+        used = 0
+        actions = Counter(duplicate=len(documents) - len(unique))
+        for document, sentences, tokens, size, share in zip(unique, split, sentence_tokens, sizes, self._allocate(sizes)):
+            if size <= share:
+                text, document_tokens = "\n".join(sentences), size
+            else:
+                text, document_tokens = self._trim(sentences, tokens, share, query_terms, idf)
+            if not text:
+                actions['dropped'] += 1
+                continue
+            actions['whole' if size <= share else 'trimmed'] += 1
+            packed.append({**document, 'text': text})
+            used += document_tokens
+
+        raw_tokens = sum(self.count_tokens(document['text']) for document in documents)
+        CONTEXT_TOKENS.observe(raw_tokens, agent=self.agent, stage="raw")
+        CONTEXT_TOKENS.observe(used, agent=self.agent, stage="packed")
+        for action, count in actions.items():
+            CONTEXT_DOCUMENTS.inc(count, agent=self.agent, action=action)
+        trace = current_trace.get()
+        if trace is not None:
+            trace['context'] = {
+                'agent': self.agent, 'raw_tokens': raw_tokens, 'packed_tokens': used,
+                'budget_tokens': self.budget_tokens, 'documents': len(documents), 'packed_documents': len(packed)
+            }
+        return packed
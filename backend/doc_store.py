@@ -0,0 +1,214 @@
+import os
+import json
+import mmap
+
+import numpy as np
+
+METADATA_COLUMNS = ('team_domain', 'channel_name')
+
+def _map_blob(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return b''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _map_array(path, dtype):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+class DocStore:
+    """Append-only, memory-mapped columnar document store addressed by FAISS row id."""
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.vocab_path = os.path.join(path, 'vocab.json')
+        self.reload()
+
+    def _column_path(self, name, suffix):
+        return os.path.join(self.path, f'{name}.{suffix}')
+
+    def reload(self):
+        self.vocab = {column: [] for column in METADATA_COLUMNS}
+        if os.path.exists(self.vocab_path):
+            with open(self.vocab_path, 'r') as f:
+                self.vocab.update(json.load(f))
+        self._codes_by_value = {
+            column: {value: code for code, value in enumerate(values)} for column, values in self.vocab.items()
+        }
+
+        self._blobs = {name: _map_blob(self._column_path(name, 'bin')) for name in ('ids', 'text')}
+        self._ends = {name: _map_array(self._column_path(name, 'idx'), np.int64) for name in ('ids', 'text')}
+        # Metadata values are interned; pages are shared between worker processes through the OS cache.
+        self._codes = {column: _map_array(self._column_path(column, 'codes'), np.int32) for column in METADATA_COLUMNS}
+        # Rows are only visible once every column has been written.
+        self._num_rows = min(len(array) for array in (*self._ends.values(), *self._codes.values()))
+
+    def __len__(self):
+        return self._num_rows
+
+    def __iter__(self):
+        for row in range(self._num_rows):
+            yield self[row]
+
+    def _string(self, name, row):
+        ends = self._ends[name]
+        start = int(ends[row - 1]) if row > 0 else 0
+        return bytes(self._blobs[name][start:int(ends[row])]).decode('utf-8')
+
+    def id(self, row):
+        return self._string('ids', row)
+
+    def text(self, row):
+        return self._string('text', row)
+
+    def metadata(self, row):
+        return {column: self.vocab[column][self._codes[column][row]] for column in METADATA_COLUMNS}
+
+    def codes(self, column):
+        return self._codes[column][:self._num_rows]
+
+    def code(self, column, value):
+        return self._codes_by_value[column].get(value)
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self._num_rows
+        if row < 0 or row >= self._num_rows:
+            raise IndexError(row)
+        return {'id': self.id(row), 'text': self.text(row), 'metadata': self.metadata(row)}
+
+    def _append_strings(self, name, values):
+        ends = self._ends[name]
+        offset = int(ends[self._num_rows - 1]) if self._num_rows else 0
+        encoded = [value.encode('utf-8') for value in values]
+        with open(self._column_path(name, 'bin'), 'ab') as f:
+            f.truncate(offset)
+            for value in encoded:
+                f.write(value)
+        return offset + np.cumsum([len(value) for value in encoded], dtype=np.int64)
+
+    def _append_array(self, path, values, dtype):
+        with open(path, 'ab') as f:
+            f.truncate(self._num_rows * np.dtype(dtype).itemsize)
+            np.asarray(values, dtype=dtype).tofile(f)
+
+    def append(self, documents):
+        if not documents:
+            return
+        codes = {column: [] for column in METADATA_COLUMNS}
+        for document in documents:
+            for column in METADATA_COLUMNS:
+                value = document['metadata'][column]
+                code = self._codes_by_value[column].get(value)
+                if code is None:
+                    code = len(self.vocab[column])
+                    self.vocab[column].append(value)
+                    self._codes_by_value[column][value] = code
+                codes[column].append(code)
+
+        tmp_vocab_path = self.vocab_path + '.tmp'
+        with open(tmp_vocab_path, 'w') as f:
+            json.dump(self.vocab, f)
+        os.replace(tmp_vocab_path, self.vocab_path)
+
+        id_ends = self._append_strings('ids', [str(document['id']) for document in documents])
+        text_ends = self._append_strings('text', [document['text'] for document in documents])
+        for column in METADATA_COLUMNS:
+            self._append_array(self._column_path(column, 'codes'), codes[column], np.int32)
+        # Offset tables are written last: a crash before this point leaves the new rows invisible.
+        self._append_array(self._column_path('ids', 'idx'), id_ends, np.int64)
+        self._append_array(self._column_path('text', 'idx'), text_ends, np.int64)
+        self.reload()
+
+    def truncate(self, num_rows):
+        if num_rows >= self._num_rows:
+            return
+        # Offset tables first, mirroring append: a crash part-way leaves the dropped rows invisible. Blobs are cut on the next append.
+        for name in ('text', 'ids'):
+            with open(self._column_path(name, 'idx'), 'r+b') as f:
+                f.truncate(num_rows * np.dtype(np.int64).itemsize)
+        for column in METADATA_COLUMNS:
+            with open(self._column_path(column, 'codes'), 'r+b') as f:
+                f.truncate(num_rows * np.dtype(np.int32).itemsize)
+        self.reload()
+
+    def migrate_json(self, json_paths):
+        documents = []
+        for json_path in json_paths:
+            if not os.path.exists(json_path):
+                continue
+            with open(json_path, 'r') as f:
+                if json_path.endswith('.jsonl'):
+                    documents += [json.loads(line) for line in f if line.strip()]
+                else:
+                    documents += json.load(f)
+        self.append(documents)
+        return len(documents)
+
+CHUNK_COLUMNS = (('parent', np.int64), ('start', np.int64), ('end', np.int64))
+
+class ChunkStore:
+    """Append-only, memory-mapped chunk table: FAISS row id -> (document row, character span of the document text)."""
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.identity = False
+        self.reload()
+
+    def _column_path(self, name):
+        return os.path.join(self.path, f'{name}.bin')
+
+    def reload(self):
+        self.identity = False
+        columns = {name: _map_array(self._column_path(name), dtype) for name, dtype in CHUNK_COLUMNS}
+        # Rows are only visible once every column has been written.
+        self._num_rows = min(len(array) for array in columns.values())
+        self.parents = columns['parent'][:self._num_rows]
+        self.starts = columns['start'][:self._num_rows]
+        self.ends = columns['end'][:self._num_rows]
+
+    def use_identity(self, num_rows):
+        # Indexes built before chunking hold one vector per document; an end of -1 means the whole text.
+        self.identity = True
+        self._num_rows = num_rows
+        self.parents = np.arange(num_rows, dtype=np.int64)
+        self.starts = np.zeros(num_rows, dtype=np.int64)
+        self.ends = np.full(num_rows, -1, dtype=np.int64)
+
+    def __len__(self):
+        return self._num_rows
+
+    def span(self, row, text):
+        end = int(self.ends[row])
+        return int(self.starts[row]), len(text) if end < 0 else end
+
+    def rows_for_parents(self, parent_rows):
+        # Chunks are appended with their document, so parents is sorted and each document owns one contiguous range.
+        parent_rows = np.asarray(parent_rows, dtype=np.int64)
+        lefts = np.searchsorted(self.parents, parent_rows, side='left')
+        counts = np.searchsorted(self.parents, parent_rows, side='right') - lefts
+        offsets = np.repeat(lefts - (np.cumsum(counts) - counts), counts)
+        return offsets + np.arange(int(counts.sum()), dtype=np.int64)
+
+    def truncate(self, num_rows):
+        if self.identity or num_rows >= self._num_rows:
+            return
+        for name, dtype in CHUNK_COLUMNS:
+            with open(self._column_path(name), 'r+b') as f:
+                f.truncate(num_rows * np.dtype(dtype).itemsize)
+        self.reload()
+
+    def append(self, parents, starts, ends):
+        if self.identity:
+            # First write to a pre-chunking index: persist the implicit one-chunk-per-document rows first.
+            rows = (self.parents, self.starts, self.ends)
+            self.identity = False
+            self._num_rows = 0
+            self.append(*rows)
+        for (name, dtype), values in reversed(list(zip(CHUNK_COLUMNS, (parents, starts, ends)))):
+            # Parent is written last: a crash before this point leaves the new rows invisible.
+            with open(self._column_path(name), 'ab') as f:
+                f.truncate(self._num_rows * np.dtype(dtype).itemsize)
+                np.asarray(values, dtype=dtype).tofile(f)
+        self.reload()
@@ -0,0 +1,171 @@
+import os
+import time
+import queue
+import atexit
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+def cache_key(model_id, text):
+    return hashlib.sha256(f"{model_id}\0{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, path: str, max_entries: int = 500_000, memory_entries: int = 4096, evict_every: int = 1000,
+                 max_pending_writes: int = 1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        self._memory = OrderedDict()
+        # The LRU lock is only held for dict operations, so the event loop never waits behind SQLite.
+        self._memory_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._writes = queue.Queue(maxsize=max_pending_writes)
+        self._writer = None
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.conn.commit()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _get_memory(self, keys):
+        found = {}
+        missing = []
+        with self._memory_lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                else:
+                    missing.append(key)
+        return found, missing
+
+    def _get_stored(self, keys, keep_in_memory):
+        found = {}
+        now = time.time()
+        with self._db_lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start+500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+                if rows:
+                    self.conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, _ in rows]
+                    )
+            self.conn.commit()
+        if keep_in_memory:
+            with self._memory_lock:
+                for key, vector in found.items():
+                    self._remember(key, vector)
+        return found
+
+    def _count(self, keys, found):
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        CACHE_REQUESTS.inc(len(found), cache="embedding", result="hit")
+        CACHE_REQUESTS.inc(len(keys) - len(found), cache="embedding", result="miss")
+
+    def get_many(self, keys, keep_in_memory: bool = True):
+        found, missing = self._get_memory(keys)
+        if missing:
+            found.update(self._get_stored(missing, keep_in_memory))
+        self._count(keys, found)
+        return found
+
+    async def aget_many(self, keys, keep_in_memory: bool = True):
+        found, missing = self._get_memory(keys)
+        if missing:
+            found.update(await asyncio.to_thread(self._get_stored, missing, keep_in_memory))
+        self._count(keys, found)
+        return found
+
+    def _write(self, items):
+        now = time.time()
+        with self._db_lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items.items()]
+            )
+            self.conn.commit()
+            self._puts_since_evict += len(items)
+            if self._puts_since_evict >= self.evict_every:
+                self._evict()
+
+    def put_many(self, items, keep_in_memory: bool = True):
+        if keep_in_memory:
+            with self._memory_lock:
+                for key, vector in items.items():
+                    self._remember(key, np.asarray(vector, dtype=np.float32))
+        self._write(items)
+
+    def put_many_later(self, items, keep_in_memory: bool = True):
+        # Request path: the vectors are served from memory at once, and SQLite writes and eviction happen on the writer thread.
+        with self._memory_lock:
+            if keep_in_memory:
+                for key, vector in items.items():
+                    self._remember(key, np.asarray(vector, dtype=np.float32))
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run_writer, name="embedding-cache-writer", daemon=True)
+                self._writer.start()
+                atexit.register(self.close)
+        try:
+            self._writes.put_nowait(items)
+        except queue.Full:
+            # Dropping is safe: a missed write only costs a re-embed later.
+            logger.warning("Embedding cache write queue is full, dropped %d vectors", len(items))
+
+    def _run_writer(self):
+        while True:
+            items = self._writes.get()
+            if items is None:
+                return
+            try:
+                self._write(items)
+            except sqlite3.Error:
+                logger.exception("Embedding cache write failed, dropped %d vectors", len(items))
+
+    def close(self):
+        if self._writer is None or not self._writer.is_alive():
+            return
+        self._writes.put(None)
+        self._writer.join(timeout=5)
+
+    def _evict(self):
+        self._puts_since_evict = 0
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+            self.conn.commit()
@@ -43,8 +43,9 @@ def extract_qa_from_xmls(data_dir, max_questions=3):
 def evaluate_retrieval(vector_search, qa_pairs, k=3):
     data = {'question': [], 'answer': [], 'contexts': [], 'ground_truth': []}
     
-    for qa in qa_pairs:
-        results = vector_search.query(qa['question'], k=k)
+    # One batched embedding call and one index search for the whole question set.
+    batch_results = vector_search.query_batch([qa['question'] for qa in qa_pairs], k=k)
+    for qa, results in zip(qa_pairs, batch_results):
         contexts = [r['text'] for r in results]
         
         data['question'].append(qa['question'])
@@ -0,0 +1,57 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+def render_message(message):
+    if isinstance(message, HumanMessage):
+        return f"<human>{message.content}</human>\n"
+    if isinstance(message, AIMessage):
+        return f"<assistant>{message.content}</assistant>\n"
+    return f"<previous-conversation>{message.content}</previous-conversation>\n"
+
+def history_fields(messages, count_tokens):
+    history = [render_message(message) for message in messages]
+    token_counts = [count_tokens(fragment) for fragment in history]
+    return {'history': history, 'history_token_counts': token_counts, 'history_tokens': sum(token_counts)}
+
+def _is_synced(state):
+    history = state.get('history') or []
+    return len(history) == len(state.get('messages') or []) and len(state.get('history_token_counts') or []) == len(history)
+
+def sync_history(state, count_tokens):
+    """Render only the messages appended since the last sync, keeping history parallel to messages."""
+    messages = state.get('messages') or []
+    history = state.get('history') or []
+    token_counts = state.get('history_token_counts') or []
+    # Checkpoints written before history was tracked (or rewritten elsewhere) are rendered from scratch once.
+    if len(history) > len(messages) or len(token_counts) != len(history):
+        state.update(history_fields(messages, count_tokens))
+        return state
+    for message in messages[len(history):]:
+        fragment = render_message(message)
+        history.append(fragment)
+        token_counts.append(count_tokens(fragment))
+        state['history_tokens'] = state.get('history_tokens', 0) + token_counts[-1]
+    state['history'] = history
+    state['history_token_counts'] = token_counts
+    return state
+
+def history_tokens(state, count_tokens):
+    if _is_synced(state):
+        return state.get('history_tokens', 0)
+    return history_fields(state.get('messages') or [], count_tokens)['history_tokens']
+
+def history_window(state, max_tokens: int = None):
+    """Newest rendered turns that fit in max_tokens, always led by the rolling summary when there is one."""
+    messages = state.get('messages') or []
+    if not _is_synced(state):
+        return "".join(render_message(message) for message in messages)
+    history = state.get('history') or []
+    if max_tokens is None:
+        return "".join(history)
+    token_counts = state.get('history_token_counts') or []
+    first = 1 if messages and isinstance(messages[0], SystemMessage) else 0
+    used = sum(token_counts[:first])
+    start = len(history)
+    while start > first and used + token_counts[start - 1] <= max_tokens:
+        start -= 1
+        used += token_counts[start]
+    return "".join(history[:first] + history[start:])
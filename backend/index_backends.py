@@ -0,0 +1,108 @@
+import math
+import logging
+
+import numpy as np
+import faiss
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ('flat', 'hnsw_flat', 'hnsw_sq8', 'ivf_pq')
+
+# Corpus sizes at which 'auto' switches to a more compact backend.
+AUTO_HNSW_MIN_VECTORS = 10_000
+AUTO_SQ8_MIN_VECTORS = 200_000
+AUTO_IVF_PQ_MIN_VECTORS = 1_000_000
+
+def choose_index_type(num_vectors):
+    if num_vectors < AUTO_HNSW_MIN_VECTORS:
+        return 'flat'
+    if num_vectors < AUTO_SQ8_MIN_VECTORS:
+        return 'hnsw_flat'
+    if num_vectors < AUTO_IVF_PQ_MIN_VECTORS:
+        return 'hnsw_sq8'
+    return 'ivf_pq'
+
+def infer_index_type(index):
+    if isinstance(index, faiss.IndexHNSWSQ):
+        return 'hnsw_sq8'
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw_flat'
+    if isinstance(index, faiss.IndexIVF):
+        return 'ivf_pq'
+    return 'flat'
+
+def default_index_params(index_type, dim, num_vectors):
+    params = {'index_type': index_type, 'dim': dim}
+    if index_type.startswith('hnsw'):
+        params.update({'num_edges': 32, 'ef_construction': 40, 'ef_search': 64})
+    elif index_type == 'ivf_pq':
+        nlist = int(min(65536, max(16, 4 * math.sqrt(max(num_vectors, 1)))))
+        # 8 dims per sub-quantizer: 96 bytes per 768-d vector instead of 3072.
+        pq_m = next(m for m in (96, 64, 48, 32, 24, 16, 8, 4, 2, 1) if dim % m == 0 and m <= dim)
+        params.update({'nlist': nlist, 'pq_m': pq_m, 'pq_nbits': 8, 'nprobe': max(1, nlist // 64)})
+    return params
+
+def min_training_vectors(params):
+    if params['index_type'] == 'ivf_pq':
+        return max(params['nlist'], 2 ** params['pq_nbits'])
+    if params['index_type'] == 'hnsw_sq8':
+        return 1
+    return 0
+
+def build_index(params, training_vectors=None, max_training_vectors=262_144, seed=1234):
+    index_type, dim = params['index_type'], params['dim']
+    if index_type == 'flat':
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == 'hnsw_flat':
+        index = faiss.IndexHNSWFlat(dim, params['num_edges'])
+    elif index_type == 'hnsw_sq8':
+        index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, params['num_edges'])
+    elif index_type == 'ivf_pq':
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, params['nlist'], params['pq_m'], params['pq_nbits'])
+    else:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+
+    if index_type.startswith('hnsw'):
+        index.hnsw.efConstruction = params['ef_construction']
+        index.hnsw.efSearch = params['ef_search']
+    if not index.is_trained:
+        sample = training_vectors
+        if len(sample) > max_training_vectors:
+            rows = np.random.default_rng(seed).choice(len(sample), max_training_vectors, replace=False)
+            sample = sample[np.sort(rows)]
+        index.train(np.ascontiguousarray(sample, dtype=np.float32))
+    prepare_index(index)
+    return index
+
+def prepare_index(index):
+    if isinstance(index, faiss.IndexIVF):
+        # Needed for reconstruct(), which the exact filtered search path relies on.
+        index.make_direct_map()
+    return index
+
+def read_index(path, mmap=False):
+    if mmap:
+        # Read-only mapping: workers share the page cache instead of each holding a private copy of the vectors.
+        # The two mmap modes cannot be combined (IVF lists reject it), so try the zero-copy one first.
+        mmap_flags = [getattr(faiss, name) for name in ('IO_FLAG_MMAP_IFC', 'IO_FLAG_MMAP') if hasattr(faiss, name)]
+        for mmap_flag in mmap_flags:
+            try:
+                return prepare_index(faiss.read_index(path, faiss.IO_FLAG_READ_ONLY | mmap_flag))
+            except RuntimeError as e:
+                logger.warning("Could not memory-map %s with flag %#x: %s", path, mmap_flag, str(e).strip().splitlines()[-1])
+        logger.warning("Reading %s into memory instead of memory-mapping it", path)
+    return prepare_index(faiss.read_index(path))
+
+def search_params(index, params, selector=None, ef_search=None, nprobe=None):
+    if isinstance(index, faiss.IndexHNSW):
+        parameters = faiss.SearchParametersHNSW()
+        parameters.efSearch = ef_search or params.get('ef_search') or index.hnsw.efSearch
+    elif isinstance(index, faiss.IndexIVF):
+        parameters = faiss.SearchParametersIVF()
+        parameters.nprobe = nprobe or params.get('nprobe') or index.nprobe
+    else:
+        parameters = faiss.SearchParameters()
+    if selector is not None:
+        parameters.sel = selector
+    return parameters
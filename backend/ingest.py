@@ -0,0 +1,38 @@
+import argparse
+
+from retrieval import EmeddingModel, VectorSearch
+from index_backends import INDEX_TYPES
+from prompt_manager import PromptManager
+
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally index Slack XML exports into the retrieval database.")
+    parser.add_argument('data_dir', help="Directory containing Slack XML exports")
+    parser.add_argument('--db-path', default='./retrieval', help="Directory holding faiss.index and the document store")
+    parser.add_argument('--batch-size', type=int, help="Texts per embedding request")
+    parser.add_argument('--concurrency', type=int, help="Embedding requests in flight at once")
+    parser.add_argument('--index-batch-size', type=int, default=1000, help="Conversations embedded and appended per batch")
+    parser.add_argument('--workers', type=int, default=1, help="Processes parsing XML files in parallel")
+    parser.add_argument('--index-type', choices=('auto',) + INDEX_TYPES,
+                        help="FAISS backend used when the index is first built (ignored for an existing index)")
+    args = parser.parse_args()
+
+    config = dict(PromptManager().get_model_config('retrieval_agent'))
+    if args.batch_size:
+        config['embedding_batch_size'] = args.batch_size
+    if args.concurrency:
+        config['embedding_max_concurrency'] = args.concurrency
+
+    vector_search = VectorSearch(
+        db_path=args.db_path,
+        data_dir=None,
+        embed_model=EmeddingModel.from_config(config, cache_dir=args.db_path),
+        index_type=args.index_type or config.get('index_type', 'auto'),
+        index_params=config.get('index_params'),
+        chunk_words=config.get('chunk_words', 256),
+        chunk_overlap_words=config.get('chunk_overlap_words', 64)
+    )
+    num_indexed = vector_search.ingest(args.data_dir, batch_size=args.index_batch_size, workers=args.workers)
+    print(f"Indexed {num_indexed} new or changed conversations ({len(vector_search.documents)} rows, {len(vector_search.chunks)} chunks total)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import argparse
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import faiss
+
+from retrieval import EmeddingModel
+from prompt_manager import PromptManager
+from query_log import read_query_log
+
+def aggregate_queries(records, min_similarity: float, since: float = None):
+    """Collapse logged queries by normalized text, keeping the ones the index answered poorly."""
+    queries = defaultdict(lambda: {'count': 0, 'similarities': [], 'first_seen': None, 'last_seen': None})
+    for record in records:
+        if since is not None and record.get('ts', 0) < since:
+            continue
+        similarity = record.get('top_vector_similarity')
+        # No vector score (lexical mode) falls back to whether anything was retrieved at all.
+        if similarity is None:
+            answered = bool(record.get('retrieved_ids'))
+        else:
+            answered = similarity >= min_similarity
+        if answered:
+            continue
+        query = queries[' '.join(record['query'].lower().split())]
+        query['count'] += 1
+        query['similarities'].append(similarity if similarity is not None else 0.0)
+        query['text'] = record['query']
+        query['first_seen'] = record['ts'] if query['first_seen'] is None else min(query['first_seen'], record['ts'])
+        query['last_seen'] = record['ts'] if query['last_seen'] is None else max(query['last_seen'], record['ts'])
+    return list(queries.values())
+
+def cluster_queries(embeddings, weights, num_clusters: int, seed: int = 0):
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    num_clusters = min(num_clusters, len(embeddings))
+    kmeans = faiss.Kmeans(embeddings.shape[1], num_clusters, niter=25, spherical=True, seed=seed)
+    kmeans.train(embeddings, weights=weights)
+    similarities, assignments = kmeans.index.search(embeddings, 1)
+    return assignments[:, 0], similarities[:, 0]
+
+def knowledge_gaps(queries, embed_model, num_clusters: int = 20, num_examples: int = 5):
+    if not queries:
+        return []
+    embeddings = np.array(embed_model.embed([query['text'] for query in queries]), dtype=np.float32)
+    weights = np.array([query['count'] for query in queries], dtype=np.float32)
+    assignments, centroid_similarities = cluster_queries(embeddings, weights, num_clusters)
+    clusters = defaultdict(list)
+    for position, cluster in enumerate(assignments):
+        clusters[int(cluster)].append(position)
+
+    rows = []
+    for cluster, positions in clusters.items():
+        members = [queries[position] for position in positions]
+        representative = queries[max(positions, key=lambda position: centroid_similarities[position])]
+        examples = sorted(members, key=lambda query: query['count'], reverse=True)[:num_examples]
+        rows.append({
+            'cluster': cluster,
+            'num_queries': int(sum(query['count'] for query in members)),
+            'num_unique_queries': len(members),
+            'mean_top_similarity': round(float(np.mean([s for query in members for s in query['similarities']])), 4),
+            'representative_query': representative['text'],
+            'example_queries': [query['text'] for query in examples],
+            'first_seen': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(min(query['first_seen'] for query in members))),
+            'last_seen': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(max(query['last_seen'] for query in members))),
+        })
+    return sorted(rows, key=lambda row: row['num_queries'], reverse=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster poorly answered queries from the query log into a knowledge-gap report.")
+    parser.add_argument('--log-dir', help="Query log directory (defaults to retrieval_agent.query_log_dir)")
+    parser.add_argument('--since-days', type=float, help="Only consider queries from the last N days")
+    parser.add_argument('--min-similarity', type=float, default=0.6,
+                        help="Queries whose best vector match scores below this count as unanswered")
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--top', type=int, default=10, help="Clusters to keep in the report")
+    parser.add_argument('--output', default='artifacts/knowledge_gaps')
+    args = parser.parse_args()
+
+    config = PromptManager().get_model_config('retrieval_agent')
+    log_dir = args.log_dir or config.get('query_log_dir', './logs/query_log')
+    since = time.time() - args.since_days * 86400 if args.since_days else None
+    queries = aggregate_queries(read_query_log(log_dir), args.min_similarity, since)
+    print(f"Found {sum(query['count'] for query in queries)} unanswered queries ({len(queries)} unique) in {log_dir}")
+
+    embed_model = EmeddingModel.from_config(config, cache_dir=config.get('db_path', './retrieval'))
+    rows = knowledge_gaps(queries, embed_model, num_clusters=args.clusters)[:args.top]
+    for row in rows:
+        print(f"{row['num_queries']:>6}  {row['representative_query']}")
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output + '.json', 'w') as f:
+        json.dump(rows, f, indent=2)
+    pd.DataFrame(rows).to_csv(args.output + '.csv', index=False)
+    print(f"Wrote {len(rows)} knowledge gaps to {args.output}.json / .csv")
+
+if __name__ == "__main__":
+    main()
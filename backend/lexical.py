@@ -0,0 +1,143 @@
+import os
+import re
+import json
+import html
+import math
+from collections import Counter
+
+import numpy as np
+
+# Keeps dotted/dashed identifiers (core.async, java.lang.NullPointerException) whole and also indexes their parts.
+TOKEN_PATTERN = re.compile(r"[a-z0-9_]+(?:[.\-/:][a-z0-9_]+)*")
+SUBTOKEN_PATTERN = re.compile(r"[.\-/:]")
+STOPWORDS = frozenset((
+    "a an and are as at be but by can do for from has have how i if in is it its me my no not of on or so "
+    "that the their then there these this to was we what when where which who will with you your"
+).split())
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(html.unescape(text).lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        if SUBTOKEN_PATTERN.search(token):
+            tokens.extend(part for part in SUBTOKEN_PATTERN.split(token) if part and part not in STOPWORDS)
+    return tokens
+
+POSTINGS_ARRAYS = ('offsets', 'rows', 'tfs', 'doc_len')
+
+class BM25Index:
+    """Inverted index over raw document text with BM25 scoring, stored as CSR postings arrays."""
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75, mmap: bool = False):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.mmap = mmap
+        # Each save writes a new generation of files and then flips current.json, so readers never see a half-written set.
+        self.current_path = os.path.join(path, 'current.json')
+        self.vocab_path = os.path.join(path, 'vocab.json')
+        self.postings_path = os.path.join(path, 'postings.npz')
+        self.generation = 0
+        self.terms = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.rows = np.zeros(0, dtype=np.int32)
+        self.tfs = np.zeros(0, dtype=np.float32)
+        self.doc_len = np.zeros(0, dtype=np.float32)
+        if os.path.exists(self.current_path) or (os.path.exists(self.vocab_path) and os.path.exists(self.postings_path)):
+            self._load()
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def _generation_path(self, generation, name):
+        return os.path.join(self.path, f'{name}.{generation}.npy' if name in POSTINGS_ARRAYS else f'{name}.{generation}.json')
+
+    def _load(self):
+        if not os.path.exists(self.current_path):
+            # Single-file layout written before generations existed.
+            with open(self.vocab_path, 'r') as f:
+                self.terms = {term: term_id for term_id, term in enumerate(json.load(f))}
+            with np.load(self.postings_path) as postings:
+                for name in POSTINGS_ARRAYS:
+                    setattr(self, name, postings[name])
+            return
+        with open(self.current_path, 'r') as f:
+            self.generation = json.load(f)['generation']
+        with open(self._generation_path(self.generation, 'vocab'), 'r') as f:
+            self.terms = {term: term_id for term_id, term in enumerate(json.load(f))}
+        for name in POSTINGS_ARRAYS:
+            setattr(self, name, np.load(self._generation_path(self.generation, name), mmap_mode='r' if self.mmap else None))
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        generation = self.generation + 1
+        for name in POSTINGS_ARRAYS:
+            np.save(self._generation_path(generation, name), getattr(self, name))
+        with open(self._generation_path(generation, 'vocab'), 'w') as f:
+            json.dump(sorted(self.terms, key=self.terms.get), f)
+        tmp_current_path = self.current_path + '.tmp'
+        with open(tmp_current_path, 'w') as f:
+            json.dump({'generation': generation}, f)
+        os.replace(tmp_current_path, self.current_path)
+        # The previous generation stays for readers that resolved current.json just before the flip.
+        for name in (*POSTINGS_ARRAYS, 'vocab'):
+            stale_path = self._generation_path(generation - 2, name)
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+        for legacy_path in (self.vocab_path, self.postings_path):
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+        self.generation = generation
+
+    def add(self, texts):
+        start_row = len(self.doc_len)
+        term_ids, rows, tfs, doc_len = [], [], [], []
+        for row, text in enumerate(texts, start=start_row):
+            counts = Counter(tokenize(text))
+            doc_len.append(sum(counts.values()))
+            for term, tf in counts.items():
+                term_ids.append(self.terms.setdefault(term, len(self.terms)))
+                rows.append(row)
+                tfs.append(tf)
+
+        # Merge the new postings into the CSR layout; the stable sort keeps each term's rows ascending.
+        old_term_ids = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int64), np.diff(self.offsets))
+        all_term_ids = np.concatenate([old_term_ids, np.array(term_ids, dtype=np.int64)])
+        order = np.argsort(all_term_ids, kind='stable')
+        self.rows = np.concatenate([self.rows, np.array(rows, dtype=np.int32)])[order]
+        self.tfs = np.concatenate([self.tfs, np.array(tfs, dtype=np.float32)])[order]
+        counts = np.bincount(all_term_ids, minlength=len(self.terms))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.doc_len = np.concatenate([self.doc_len, np.array(doc_len, dtype=np.float32)])
+
+    def search(self, query, k, allowed_rows=None, excluded_rows=None):
+        num_docs = len(self.doc_len)
+        term_ids = {self.terms[term] for term in tokenize(query) if term in self.terms}
+        if not num_docs or not term_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        avg_len = max(float(self.doc_len.mean()), 1.0)
+        matched_rows, contributions = [], []
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            rows, tfs = self.rows[start:end], self.tfs[start:end]
+            idf = math.log(1.0 + (num_docs - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[rows] / avg_len)
+            matched_rows.append(rows)
+            contributions.append(idf * tfs * (self.k1 + 1.0) / (tfs + norm))
+
+        candidates, inverse = np.unique(np.concatenate(matched_rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions)).astype(np.float32)
+        keep = np.ones(len(candidates), dtype=bool)
+        if allowed_rows is not None:
+            keep &= np.isin(candidates, allowed_rows)
+        if excluded_rows is not None and len(excluded_rows):
+            keep &= ~np.isin(candidates, excluded_rows)
+        candidates, scores = candidates[keep], scores[keep]
+
+        if len(candidates) > k:
+            top = np.argpartition(-scores, k)[:k]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return candidates[order].astype(np.int64), scores[order]
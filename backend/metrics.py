@@ -0,0 +1,156 @@
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RATE_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800, 1600)
+
+REGISTRY = []
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        with self._lock:
+            # [cumulative bucket counts..., sum, count]
+            values = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[position] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, values):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {values[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {values[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {values[-1]}")
+        return lines
+
+def render_metrics():
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+CHAT_REQUESTS = Counter("sherlock_chat_requests_total", "Chat requests by outcome", ("outcome",))
+NODE_SECONDS = Histogram("sherlock_node_seconds", "Wall time per LangGraph node", ("node",))
+LLM_TTFT_SECONDS = Histogram("sherlock_llm_time_to_first_token_seconds", "Time to first streamed chunk", ("model",))
+LLM_TOKENS_PER_SECOND = Histogram("sherlock_llm_tokens_per_second", "Streamed chunks per second after the first", ("model",), RATE_BUCKETS)
+EMBEDDING_SECONDS = Histogram("sherlock_embedding_seconds", "Query embedding latency, including coalesced waits", ())
+SEARCH_SECONDS = Histogram("sherlock_search_seconds", "Index search latency", ("kind",), (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+CONTEXT_TOKENS = Histogram("sherlock_context_tokens", "Prompt context size before and after packing", ("agent", "stage"), (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768))
+CONTEXT_DOCUMENTS = Counter("sherlock_context_documents_total", "Retrieved passages kept whole, trimmed, or dropped by the context packer", ("agent", "action"))
+SEARCH_BATCH_SIZE = Histogram("sherlock_search_batch_size", "Queries per index search call", ("kind",), (1, 2, 4, 8, 16, 32, 64, 128))
+CACHE_REQUESTS = Counter("sherlock_cache_requests_total", "Cache lookups by cache and result", ("cache", "result"))
+DECISIONS = Counter("sherlock_decisions_total", "Which path an agent took (local classifier vs remote model, fast path vs rewrite)", ("agent", "path"))
+QUERY_LOG_RECORDS = Counter("sherlock_query_log_records_total", "Query log records queued or dropped", ("result",))
+SCHEDULER_WAIT_SECONDS = Histogram("sherlock_scheduler_wait_seconds", "Time spent queued for an upstream model slot", ("model", "priority"))
+
+# Per-request trace: node spans are appended by timed_node and emitted once by the API at the end of the request.
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def start_trace(**fields):
+    trace = {**fields, 'spans': [], 'started_at': time.time()}
+    current_trace.set(trace)
+    return trace
+
+def finish_trace(trace, sample_rate: float = 1.0, **fields):
+    if trace is None or not logger.isEnabledFor(logging.INFO) or random.random() >= sample_rate:
+        return
+    trace.update(fields)
+    trace['total_seconds'] = round(time.time() - trace.pop('started_at'), 4)
+    logger.info("trace %s", json.dumps(trace, default=str))
+
+def timed_node(name, node):
+    @wraps(node)
+    async def wrapper(state):
+        start = time.perf_counter()
+        try:
+            return await node(state)
+        finally:
+            elapsed = time.perf_counter() - start
+            NODE_SECONDS.observe(elapsed, node=name)
+            trace = current_trace.get()
+            if trace is not None:
+                trace['spans'].append({'node': name, 'seconds': round(elapsed, 4)})
+    return wrapper
+
+def summarize_state(state):
+    summary = {}
+    for key, value in state.items():
+        if isinstance(value, list):
+            summary[key] = f"<{len(value)} items>"
+        elif hasattr(value, 'content'):
+            summary[key] = value.content[:200]
+        elif hasattr(value, 'shape'):
+            summary[key] = f"<array {value.shape}>"
+        else:
+            summary[key] = value
+    return summary
+
+state_log_sample_rate = 0.0
+
+def configure_logging(config: dict):
+    global state_log_sample_rate
+    logging.basicConfig(level=config.get('log_level', 'INFO'), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    state_log_sample_rate = config.get('state_log_sample_rate', 0.0)
+
+def log_state(node_logger, label, state):
+    # State dumps are debug-only and sampled: rendering full histories on every node is itself a hot path under load.
+    if not node_logger.isEnabledFor(logging.DEBUG) or random.random() >= state_log_sample_rate:
+        return
+    node_logger.debug("%s %s", label, summarize_state(state))
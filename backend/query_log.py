@@ -0,0 +1,102 @@
+import os
+import glob
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+
+from metrics import QUERY_LOG_RECORDS
+
+logger = logging.getLogger(__name__)
+
+class QueryLog:
+    """Append-only JSONL query log written in batches by a background thread, rotated by size and age."""
+    def __init__(self, log_dir: str, max_pending: int = 10_000, batch_size: int = 256,
+                 flush_interval_seconds: float = 1.0, max_segment_bytes: int = 64 * 1024 * 1024,
+                 max_segment_seconds: float = 3600):
+        self.log_dir = log_dir
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_seconds = max_segment_seconds
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._segment = None
+        self._segment_opened_at = 0.0
+        self._closed = threading.Event()
+        self._writer = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(
+            config.get('query_log_dir', './logs/query_log'),
+            max_pending=config.get('query_log_max_pending', 10_000),
+            batch_size=config.get('query_log_batch_size', 256),
+            flush_interval_seconds=config.get('query_log_flush_interval_seconds', 1.0),
+            max_segment_bytes=config.get('query_log_max_segment_mb', 64) * 1024 * 1024,
+            max_segment_seconds=config.get('query_log_max_segment_seconds', 3600)
+        )
+
+    def record(self, entry: dict):
+        # Never blocks the caller: when the writer falls behind, records are dropped and counted.
+        try:
+            self._pending.put_nowait(entry)
+            QUERY_LOG_RECORDS.inc(result="queued")
+        except queue.Full:
+            QUERY_LOG_RECORDS.inc(result="dropped")
+
+    def _open_segment(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        path = os.path.join(self.log_dir, f"queries-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl")
+        self._segment = open(path, 'a', encoding='utf-8')
+        self._segment_opened_at = time.time()
+
+    def _write(self, batch):
+        if self._segment is not None and (
+            self._segment.tell() >= self.max_segment_bytes
+            or time.time() - self._segment_opened_at >= self.max_segment_seconds
+        ):
+            self._segment.close()
+            self._segment = None
+        if self._segment is None:
+            self._open_segment()
+        self._segment.write(''.join(json.dumps(entry, default=str) + '\n' for entry in batch))
+        self._segment.flush()
+
+    def _run(self):
+        while not (self._closed.is_set() and self._pending.empty()):
+            batch = []
+            deadline = time.monotonic() + self.flush_interval_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if not batch:
+                continue
+            try:
+                self._write(batch)
+            except OSError:
+                QUERY_LOG_RECORDS.inc(len(batch), result="dropped")
+                logger.exception("Query log write failed, dropped %d records", len(batch))
+        if self._segment is not None:
+            self._segment.close()
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._writer.join(timeout=5 + self.flush_interval_seconds)
+
+def read_query_log(log_dir: str):
+    for path in sorted(glob.glob(os.path.join(log_dir, 'queries-*.jsonl'))):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # A crash can leave a torn last line in the active segment.
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
@@ -1,144 +1,1003 @@
 import os
 import re
 import json
-from collections import defaultdict
+import time
+import random
+import shutil
+import asyncio
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict, defaultdict
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 import faiss
 
-def extract_qa_from_slack_xmls(data_dir):
-    conversations = defaultdict(str)
+from doc_store import METADATA_COLUMNS, ChunkStore, DocStore
+from lexical import BM25Index, tokenize
+from index_backends import (
+    build_index,
+    choose_index_type,
+    default_index_params,
+    infer_index_type,
+    min_training_vectors,
+    read_index,
+    search_params,
+)
+from embedding_cache import EmbeddingCache, cache_key, normalize_text
+from query_log import QueryLog
+from metrics import CACHE_REQUESTS, EMBEDDING_SECONDS, SEARCH_BATCH_SIZE, SEARCH_SECONDS
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_MODES = ('vector', 'lexical', 'hybrid')
+
+def list_slack_xmls(data_dir):
+    filepaths = []
     for root, dirs, files in os.walk(data_dir):
         for filename in files:
             if filename.endswith('.xml'):
-                filepath = os.path.join(root, filename)
-                tree = ET.parse(filepath)
-                xml_root = tree.getroot()
-                team_domain = xml_root.find('team_domain').text
-                channel_name = xml_root.find('channel_name').text
-                for message in xml_root.findall('message'):
-                    conv_id = message.get('conversation_id')+f"_{team_domain}"+f"_{channel_name}"
-                    if conversations[conv_id]:
-                        text = message.find('text').text
-                        text = text if text else ''
-                        conversations[conv_id]+= text+"\n"
-                    else:
-                        text = message.find('text').text
-                        text = text if text else ''
-                        conversations[conv_id]= text+"\n"
-    def decouple_id_and_names(data):
-        id, team_domain, channel_name = data[0].split('_')
-        return {'id':id, 'text': data[1], 'metadata':{'team_domain':team_domain, 'channel_name':channel_name}}
-
-    conversations_data = list(map(lambda x: decouple_id_and_names(x),tuple(conversations.items())))
-    return conversations_data
+                filepaths.append(os.path.join(root, filename))
+    return sorted(filepaths)
+
+def iter_slack_xml(filepath):
+    team_domain = channel_name = None
+    context = ET.iterparse(filepath, events=('start', 'end'))
+    _, xml_root = next(context)
+    for event, element in context:
+        if event != 'end':
+            continue
+        if element.tag == 'team_domain':
+            team_domain = element.text
+        elif element.tag == 'channel_name':
+            channel_name = element.text
+        elif element.tag == 'message':
+            yield (element.get('conversation_id'), team_domain, channel_name), element.findtext('text') or ''
+            # Drop consumed messages so memory stays flat on year-long exports.
+            xml_root.clear()
+
+def parse_slack_xml(filepath):
+    conversations = defaultdict(list)
+    for conv_id, text in iter_slack_xml(filepath):
+        conversations[conv_id].append(text+"\n")
+    return {conv_id: "".join(parts) for conv_id, parts in conversations.items()}
+
+def scan_conversation_ids(filepath):
+    return {conv_id for conv_id, _ in iter_slack_xml(filepath)}
+
+def parse_slack_xmls(filepaths, workers: int = 1):
+    if workers <= 1:
+        yield from zip(filepaths, map(parse_slack_xml, filepaths))
+        return
+    with multiprocessing.Pool(workers) as pool:
+        yield from zip(filepaths, pool.imap(parse_slack_xml, filepaths))
+
+def merge_conversations(parsed):
+    conversations = defaultdict(list)
+    for file_conversations in parsed:
+        for conv_id, text in file_conversations.items():
+            conversations[conv_id].append(text)
+    return {conv_id: "".join(parts) for conv_id, parts in conversations.items()}
+
+def to_document(conv_id, text):
+    id, team_domain, channel_name = conv_id
+    return {'id':id, 'text': text, 'metadata':{'team_domain':team_domain, 'channel_name':channel_name}}
+
+def conversation_key(conv_id):
+    id, team_domain, channel_name = conv_id
+    return f"{team_domain}/{channel_name}/{id}"
+
+def document_conv_id(document):
+    return (document['id'], document['metadata']['team_domain'], document['metadata']['channel_name'])
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def file_hash(filepath, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
+def extract_qa_from_slack_xmls(data_dir, workers: int = 1):
+    conversations = merge_conversations(conversations for _, conversations in parse_slack_xmls(list_slack_xmls(data_dir), workers))
+    return [to_document(conv_id, text) for conv_id, text in conversations.items()]
+
+
+def preprocess_code_heavy_text(text, max_chars = 1500):
+    text = text.replace('&gt;', '>')
+    text = text.replace('&lt;', '<')
+    text = text.replace('&amp;', '&')
+    text = text.replace('&quot;', '"')
+    text = re.sub(r'```[\s\S]*?```', ' [CODE BLOCK] ', text)
+    text = re.sub(r'`[^`]+`', ' [CODE] ', text)
+    text = re.sub(r'https?://\S+', ' [URL] ', text)
+    text = re.sub(r'#object\[[^\]]+\]', ' [JAVA_OBJECT] ', text)
+    text = re.sub(r'\(ins\)', '', text)
+    text = re.sub(r'\(cmd\)', '', text)
+    text = re.sub(r'=>', ' to ', text)
+    text = re.sub(r'[(){}\[\]<>]', ' ', text)
+    text = re.sub(r'\s+', ' ', text).strip()
+    if len(text) > max_chars:
+        text = text[:max_chars].rsplit(' ', 1)[0]
+    return text
+
+def parse_text(documents, max_tokens=512):
+    WORDS_PER_TOKEN = 0.75
+    max_words = int(max_tokens * WORDS_PER_TOKEN)
+
+    text = documents['text']
+    text = preprocess_code_heavy_text(text)
+    words = text.split()
+
+    if len(words) > max_words:
+        words = words[:max_words]
+    return " ".join(words)
+
+def chunk_spans(text, chunk_words=256, overlap_words=64):
+    """Character spans of overlapping word windows over a conversation; short conversations are one chunk."""
+    words = [match.span() for match in re.finditer(r'\S+', text)]
+    if len(words) <= chunk_words:
+        return [(0, len(text))]
+    step = chunk_words - overlap_words
+    return [
+        (words[first][0], words[min(first + chunk_words, len(words)) - 1][1])
+        for first in range(0, len(words) - overlap_words, step)
+    ]
+
+def merge_spans(spans):
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def is_retryable_error(error):
+    status = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    if status in (429, 500, 502, 503, 504):
+        return True
+    message = str(error)
+    return '429' in message or 'RESOURCE_EXHAUSTED' in message or 'UNAVAILABLE' in message
+
+def is_rate_limited(error):
+    status = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    return status == 429 or '429' in str(error) or 'RESOURCE_EXHAUSTED' in str(error)
 
 class EmeddingModel:
-    def __init__(self, model_id = "models/text-embedding-004"):
+    def __init__(self, model_id = "models/text-embedding-004", batch_size: int = 100, max_concurrency: int = 4,
+                 max_retries: int = 6, backoff_base: float = 1.0, backoff_max: float = 60.0,
+                 cache: EmbeddingCache = None):
+        self.model_id = model_id
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
         self.model = GoogleGenerativeAIEmbeddings(
                     model=model_id,
                     )
-        
-    def embed(self, text):
-        return self.model.embed_documents(text)
+        # Shared across workers: a 429 on one batch pauses every batch, not just the one that failed.
+        self._cooldown_until = 0.0
+        self._cooldown_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, cache_dir: str = None):
+        cache = None
+        if cache_dir and config.get('embedding_cache', True):
+            cache = EmbeddingCache(
+                os.path.join(cache_dir, 'embedding_cache.sqlite'),
+                max_entries=config.get('embedding_cache_max_entries', 500_000),
+                memory_entries=config.get('embedding_cache_memory_entries', 4096),
+            )
+        return cls(
+            model_id=config.get('embedding_model_id', "models/text-embedding-004"),
+            batch_size=config.get('embedding_batch_size', 100),
+            max_concurrency=config.get('embedding_max_concurrency', 4),
+            max_retries=config.get('embedding_max_retries', 6),
+            cache=cache,
+        )
+
+    def _backoff(self, attempt, error):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+        if is_rate_limited(error):
+            with self._cooldown_lock:
+                self._cooldown_until = max(self._cooldown_until, time.monotonic() + delay)
+        return delay
+
+    def _cooldown_remaining(self):
+        return max(0.0, self._cooldown_until - time.monotonic())
+
+    def _embed_batch(self, batch):
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._cooldown_remaining())
+            try:
+                return np.array(self.model.embed_documents(batch), dtype=np.float32)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable_error(e):
+                    raise
+                time.sleep(self._backoff(attempt, e))
+
+    async def _aembed_batch(self, batch):
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._cooldown_remaining())
+            try:
+                return np.array(await self.model.aembed_documents(batch), dtype=np.float32)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable_error(e):
+                    raise
+                await asyncio.sleep(self._backoff(attempt, e))
+
+    def _batches(self, text):
+        return [text[i:i+self.batch_size] for i in range(0, len(text), self.batch_size)]
+
+    def _load_progress(self, progress_path, text):
+        fingerprint = hashlib.sha256()
+        fingerprint.update(f"{self.model_id}:{self.batch_size}:{len(text)}".encode('utf-8'))
+        for item in text:
+            fingerprint.update(item.encode('utf-8') + b'\0')
+        fingerprint = fingerprint.hexdigest()
+
+        fingerprint_path = os.path.join(progress_path, 'fingerprint')
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path, 'r') as f:
+                if f.read() != fingerprint:
+                    shutil.rmtree(progress_path)
+        os.makedirs(progress_path, exist_ok=True)
+        with open(fingerprint_path, 'w') as f:
+            f.write(fingerprint)
+
+        completed = {}
+        for filename in os.listdir(progress_path):
+            if filename.startswith('batch_') and filename.endswith('.npy'):
+                completed[int(filename[len('batch_'):-len('.npy')])] = np.load(os.path.join(progress_path, filename))
+        return completed
+
+    def _save_progress(self, progress_path, batch_idx, embeddings):
+        batch_path = os.path.join(progress_path, f'batch_{batch_idx:06d}.npy')
+        np.save(batch_path + '.tmp.npy', embeddings)
+        os.replace(batch_path + '.tmp.npy', batch_path)
+
+    def _embed_uncached(self, text, progress_path=None):
+        batches = self._batches(text)
+        results = self._load_progress(progress_path, text) if progress_path else {}
+        pending = [idx for idx in range(len(batches)) if idx not in results]
+        if results:
+            print(f"Resuming embedding: {len(results)}/{len(batches)} batches already done")
+
+        pool = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            futures = {pool.submit(self._embed_batch, batches[idx]): idx for idx in pending}
+            for future in as_completed(futures):
+                idx = futures[future]
+                results[idx] = future.result()
+                if progress_path:
+                    self._save_progress(progress_path, idx, results[idx])
+                if len(batches) > 1:
+                    print(f"Embedded batch {len(results)}/{len(batches)}")
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        if progress_path:
+            shutil.rmtree(progress_path, ignore_errors=True)
+        return np.concatenate([results[idx] for idx in range(len(batches))])
+
+    async def _aembed_uncached(self, text):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(batch):
+            async with semaphore:
+                return await self._aembed_batch(batch)
+
+        results = await asyncio.gather(*(run(batch) for batch in self._batches(text)))
+        return np.concatenate(results)
+
+    def _cache_keys(self, text):
+        text = [normalize_text(item) for item in text]
+        return text, [cache_key(self.model_id, item) for item in text]
+
+    def _missing(self, keys, text, cached):
+        # Identical texts in one call are embedded once.
+        missing = {key: item for key, item in zip(keys, text) if key not in cached}
+        return list(missing), list(missing.values())
+
+    def _join_cached(self, keys, cached, fresh):
+        cached.update(fresh)
+        return np.stack([cached[key] for key in keys]).astype(np.float32, copy=False)
+
+    def embed(self, text, progress_path=None, keep_in_memory: bool = True):
+        if not text:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self.cache is None:
+            return self._embed_uncached(text, progress_path)
+        text, keys = self._cache_keys(text)
+        cached = self.cache.get_many(keys, keep_in_memory=keep_in_memory)
+        missing, missing_text = self._missing(keys, text, cached)
+        fresh = dict(zip(missing, self._embed_uncached(missing_text, progress_path))) if missing_text else {}
+        if fresh:
+            self.cache.put_many(fresh, keep_in_memory=keep_in_memory)
+        return self._join_cached(keys, cached, fresh)
+
+    async def aembed(self, text, keep_in_memory: bool = True):
+        if not text:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self.cache is None:
+            return await self._aembed_uncached(text)
+        text, keys = self._cache_keys(text)
+        # Memory hits stay on the loop; SQLite reads run in a thread and writes go behind on the cache's writer thread.
+        cached = await self.cache.aget_many(keys, keep_in_memory=keep_in_memory)
+        missing, missing_text = self._missing(keys, text, cached)
+        fresh = dict(zip(missing, await self._aembed_uncached(missing_text))) if missing_text else {}
+        if fresh:
+            self.cache.put_many_later(fresh, keep_in_memory=keep_in_memory)
+        return self._join_cached(keys, cached, fresh)
 
 class VectorSearch:
-    def __init__(self, db_path: str = './retrieval', dim: int = 768, num_edges: int = 32, ef_construction: int = 40):
+    def __init__(self, db_path: str = './retrieval', dim: int = 768, num_edges: int = 32, ef_construction: int = 40,
+                 index_type: str = 'auto', index_params: dict = None, ef_search: int = None, nprobe: int = None,
+                 data_dir: str = '../data/clojurians/2019', embed_model: EmeddingModel = None,
+                 exact_filter_threshold: int = 4096, retrieval_mode: str = 'vector', rrf_k: int = 60,
+                 fusion_candidates: int = 20, query_cache_entries: int = 256, lazy_load: bool = False,
+                 read_only: bool = False, mmap_index: bool = False, reload_interval: float = None,
+                 query_log: QueryLog = None, chunk_words: int = 256, chunk_overlap_words: int = 64,
+                 chunk_overfetch: int = 4, max_chunks_per_result: int = 2):
         self.db_path = db_path
         self.dim = dim
         self.num_edges = num_edges
         self.ef_construction = ef_construction
+        self.index_type = index_type
+        self.index_params = dict(index_params or {})
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+        self.exact_filter_threshold = exact_filter_threshold
+        self.retrieval_mode = retrieval_mode
+        self.rrf_k = rrf_k
+        self.fusion_candidates = fusion_candidates
+        self.chunk_words = chunk_words
+        self.chunk_overlap_words = chunk_overlap_words
+        self.chunk_overfetch = chunk_overfetch
+        self.max_chunks_per_result = max_chunks_per_result
         self.index_path = os.path.join(db_path, 'faiss.index')
-        self.doc_db_path = os.path.join(db_path, 'doc_db.json')
-        self.query_log_db_path = os.path.join(db_path, 'query_log_db.json')
-        self.documents = []
-        self.query_log = []
+        self.index_params_path = os.path.join(db_path, 'index_params.json')
+        self.doc_store_path = os.path.join(db_path, 'doc_store')
+        self.chunk_store_path = os.path.join(db_path, 'chunks')
+        self.legacy_doc_db_paths = [os.path.join(db_path, 'doc_db.json'), os.path.join(db_path, 'doc_db.jsonl')]
+        self.manifest_path = os.path.join(db_path, 'manifest.json')
+        self.staged_embeddings_path = os.path.join(db_path, 'staged_embeddings.f32')
+        self.version_path = os.path.join(db_path, 'VERSION')
+        self.read_only = read_only
+        self.mmap_index = mmap_index
+        self.reload_interval = reload_interval
+        self.documents = DocStore(self.doc_store_path)
+        self.chunks = ChunkStore(self.chunk_store_path)
+        self.lexical = BM25Index(os.path.join(db_path, 'bm25'), mmap=read_only)
+        self.query_log = query_log
         self.indexes = None
-        self.embed_model = EmeddingModel()
+        self.manifest = {'files': {}, 'conversations': {}, 'tombstones': []}
+        self._tombstone_selector = None
+        self._chunk_tombstones = None
+        self._postings = {}
+        self.embed_model = embed_model or EmeddingModel()
+        self.query_cache_entries = query_cache_entries
+        self._query_embeddings = OrderedDict()
+        self.embed_progress_path = os.path.join(db_path, 'embed_progress')
+        self._loaded = False
+        self._loaded_version = None
+        self._last_version_check = 0.0
+        self._load_lock = threading.Lock()
 
-        if os.path.exists(self.index_path) and os.path.exists(self.doc_db_path):
+        if lazy_load:
+            # Serving mode: nothing is read until the first query, and the index is only ever built offline (ingest.py).
+            return
+        has_documents = len(self.documents) > 0 or any(map(os.path.exists, self.legacy_doc_db_paths))
+        if os.path.exists(self.index_path) and has_documents:
             self._load_from_disk()
+        elif data_dir:
+            self.ingest(data_dir)
+        self._loaded = True
+
+    def _create_index(self, embeddings):
+        index_type = self.index_type if self.index_type != 'auto' else choose_index_type(len(embeddings))
+        params = default_index_params(index_type, self.dim, len(embeddings))
+        if index_type.startswith('hnsw'):
+            params.update({'num_edges': self.num_edges, 'ef_construction': self.ef_construction})
+        params.update(self.index_params)
+        if len(embeddings) < min_training_vectors(params):
+            print(f"Only {len(embeddings)} vectors to train '{index_type}', falling back to 'hnsw_flat'")
+            params = default_index_params('hnsw_flat', self.dim, len(embeddings))
+            params.update({'num_edges': self.num_edges, 'ef_construction': self.ef_construction})
+        self.indexes = build_index(params, training_vectors=embeddings)
+        self.index_params = params
+
+    def _published_version(self):
+        try:
+            with open(self.version_path, 'r') as f:
+                return json.load(f)['version']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _publish_version(self):
+        tmp_version_path = self.version_path + '.tmp'
+        with open(tmp_version_path, 'w') as f:
+            json.dump({'version': self.version, 'published_at': time.time()}, f)
+        os.replace(tmp_version_path, self.version_path)
+
+    def _read_snapshot(self):
+        # The version is read first: a publish that lands mid-read is picked up by the next check.
+        snapshot = {'version': self._published_version(), 'indexes': None, 'manifest': {'files': {}, 'conversations': {}, 'tombstones': []}}
+        snapshot['documents'] = DocStore(self.doc_store_path)
+        snapshot['chunks'] = ChunkStore(self.chunk_store_path)
+        snapshot['lexical'] = BM25Index(os.path.join(self.db_path, 'bm25'), mmap=self.read_only)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                snapshot['manifest'] = json.load(f)
+        if not os.path.exists(self.index_path):
+            return snapshot
+        snapshot['indexes'] = read_index(self.index_path, mmap=self.mmap_index)
+        if not len(snapshot['chunks']):
+            snapshot['chunks'].use_identity(snapshot['indexes'].ntotal)
+        if self.read_only and not self._covers_index(snapshot):
+            # Serving never migrates or repairs: a store that lags the index would fail every lookup, so serve nothing instead.
+            logger.error(
+                "%s holds %d vectors but its document store only has %d documents and %d chunks. "
+                "Run ingest.py against this db_path to build or migrate it; retrieval is disabled until then.",
+                self.index_path, snapshot['indexes'].ntotal, len(snapshot['documents']), len(snapshot['chunks'])
+            )
+            snapshot['indexes'] = None
+            return snapshot
+        if os.path.exists(self.index_params_path):
+            with open(self.index_params_path, 'r') as f:
+                snapshot['index_params'] = {**json.load(f), **self.index_params}
         else:
-            self.indexes = faiss.IndexHNSWFlat(self.dim, self.num_edges)
-            self.indexes.hnsw.efConstruction = self.ef_construction
-            data_db_path = '../data/clojurians/2019'
-            documents = extract_qa_from_slack_xmls(data_db_path)
-            self.index(documents)
+            snapshot['index_params'] = {**default_index_params(infer_index_type(snapshot['indexes']), self.dim, snapshot['indexes'].ntotal),
+                                        'ef_search': None, **self.index_params}
+        return snapshot
 
-    def _load_from_disk(self):
-        self.indexes = faiss.read_index(self.index_path)
+    def _covers_index(self, snapshot):
+        num_chunks = snapshot['indexes'].ntotal
+        if len(snapshot['chunks']) < num_chunks:
+            return False
+        return not num_chunks or len(snapshot['documents']) > int(snapshot['chunks'].parents[num_chunks - 1])
 
-        with open(self.doc_db_path, 'r') as f:
-            self.documents = json.load(f)
+    def _apply_snapshot(self, snapshot):
+        # Plain attribute swaps with no await in between; in-flight searches keep the objects they already hold.
+        self.indexes = snapshot['indexes']
+        self.index_params = snapshot.get('index_params', self.index_params)
+        self.documents = snapshot['documents']
+        self.chunks = snapshot['chunks']
+        self.lexical = snapshot['lexical']
+        self.manifest = snapshot['manifest']
+        self._tombstone_selector = None
+        self._chunk_tombstones = None
+        self._postings = {}
+        self._loaded_version = snapshot['version']
+        self._loaded = True
 
-        # with open(self.query_log_db_path, 'r') as f:
-        #     self.query_log = json.load(f)
+    def _should_load(self):
+        if not self._loaded:
+            return True
+        if self.reload_interval is None or time.monotonic() - self._last_version_check < self.reload_interval:
+            return False
+        self._last_version_check = time.monotonic()
+        return self._published_version() != self._loaded_version
+
+    def ensure_loaded(self):
+        if not self._should_load():
+            return
+        with self._load_lock:
+            snapshot = self._read_snapshot()
+        self._apply_snapshot(snapshot)
+        logger.info("Loaded retrieval index version %s (%d documents)", self._loaded_version, len(self.documents))
+
+    async def aensure_loaded(self):
+        if not self._should_load():
+            return
+        def read_locked():
+            with self._load_lock:
+                return self._read_snapshot()
+        snapshot = await asyncio.to_thread(read_locked)
+        self._apply_snapshot(snapshot)
+        logger.info("Loaded retrieval index version %s (%d documents)", self._loaded_version, len(self.documents))
+
+    def _load_from_disk(self):
+        self._apply_snapshot(self._read_snapshot())
+        if not self.read_only:
+            self._migrate_legacy()
+            self._discard_uncommitted()
+
+        if len(self.lexical) < len(self.documents):
+            self.lexical.add(self.documents.text(row) for row in range(len(self.lexical), len(self.documents)))
+            self.lexical.save()
 
     def _save_to_disk(self):
         os.makedirs(self.db_path, exist_ok=True)
-        faiss.write_index(self.indexes, self.index_path)
-        with open(self.doc_db_path, 'w') as f:
-            json.dump(self.documents, f, indent=2)
+        tmp_index_path = self.index_path + '.tmp'
+        faiss.write_index(self.indexes, tmp_index_path)
+        os.replace(tmp_index_path, self.index_path)
+        tmp_params_path = self.index_params_path + '.tmp'
+        with open(tmp_params_path, 'w') as f:
+            json.dump(self.index_params, f)
+        os.replace(tmp_params_path, self.index_params_path)
+        self.lexical.save()
 
-    def index(self, documents):
-        def parse_text(documents, max_tokens=512):
-            WORDS_PER_TOKEN = 0.75
-            max_words = int(max_tokens * WORDS_PER_TOKEN)
-            
-            text = documents['text']
-            text = preprocess_code_heavy_text(text)
-            words = text.split()
-            
-            if len(words) > max_words:
-                words = words[:max_words]
-            return " ".join(words)
-
-        def preprocess_code_heavy_text(text, max_chars = 1500):
-            text = text.replace('&gt;', '>')
-            text = text.replace('&lt;', '<')
-            text = text.replace('&amp;', '&')
-            text = text.replace('&quot;', '"')
-            text = re.sub(r'```[\s\S]*?```', ' [CODE BLOCK] ', text)
-            text = re.sub(r'`[^`]+`', ' [CODE] ', text)
-            text = re.sub(r'https?://\S+', ' [URL] ', text)
-            text = re.sub(r'#object\[[^\]]+\]', ' [JAVA_OBJECT] ', text)
-            text = re.sub(r'\(ins\)', '', text)
-            text = re.sub(r'\(cmd\)', '', text)
-            text = re.sub(r'=>', ' to ', text)
-            text = re.sub(r'[(){}\[\]<>]', ' ', text)
-            text = re.sub(r'\s+', ' ', text).strip()
-            if len(text) > max_chars:
-                text = text[:max_chars].rsplit(' ', 1)[0]
-            return text
-
-        text = list(map(lambda x: parse_text(x), documents))
-        embeddings = np.array(self.embed_model.embed(text), dtype=np.float32)
-        self.indexes.add(embeddings)
-        self.documents+=documents
+    def _migrate_legacy(self):
+        if self.indexes is not None and not len(self.documents):
+            num_migrated = self.documents.migrate_json(self.legacy_doc_db_paths)
+            print(f"Migrated {num_migrated} documents from JSON into {self.doc_store_path}")
+
+    def _discard_uncommitted(self):
+        # faiss.index is written once per ingest: rows an interrupted ingest appended after it have no vectors.
+        num_chunks = self.indexes.ntotal if self.indexes is not None else 0
+        num_documents = int(self.chunks.parents[num_chunks - 1]) + 1 if num_chunks else 0
+        if len(self.chunks) > num_chunks or len(self.documents) > num_documents:
+            print(f"Discarding {len(self.documents) - num_documents} documents left by an interrupted ingest")
+            self.chunks.truncate(num_chunks)
+            self.documents.truncate(num_documents)
+        if os.path.exists(self.staged_embeddings_path):
+            os.remove(self.staged_embeddings_path)
+
+    def _save_manifest(self):
+        os.makedirs(self.db_path, exist_ok=True)
+        tmp_manifest_path = self.manifest_path + '.tmp'
+        with open(tmp_manifest_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_manifest_path, self.manifest_path)
+        # Serving processes watch VERSION and swap to the new index once everything it describes is on disk.
+        self._publish_version()
+
+    def _bootstrap_manifest(self):
+        # Indexes built before manifests existed: adopt their rows so unchanged conversations are not re-embedded.
+        conversations = self.manifest['conversations']
+        tombstones = set(self.manifest['tombstones'])
+        for row, document in enumerate(self.documents):
+            key = conversation_key(document_conv_id(document))
+            if key in conversations:
+                tombstones.add(conversations[key]['row'])
+            conversations[key] = {'hash': content_hash(document['text']), 'row': row, 'files': []}
+        self.manifest['tombstones'] = sorted(tombstones)
+
+    def ingest(self, data_dir, batch_size: int = 1000, workers: int = 1):
+        self.ensure_loaded()
+        self._migrate_legacy()
+        self._discard_uncommitted()
+        if len(self.documents) and not self.manifest['conversations']:
+            self._bootstrap_manifest()
+
+        files = self.manifest['files']
+        conversations = self.manifest['conversations']
+        filepaths = {os.path.relpath(path, data_dir): path for path in list_slack_xmls(data_dir)}
+
+        changed = {}
+        for rel_path, path in filepaths.items():
+            stat = os.stat(path)
+            entry = files.get(rel_path)
+            if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                continue
+            digest = file_hash(path)
+            if entry and entry['sha256'] == digest:
+                entry['mtime'] = stat.st_mtime
+                continue
+            changed[rel_path] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha256': digest}
+
+        if not changed:
+            self._save_manifest()
+            return 0
+
+        # A conversation can span several exports of the same channel, so every file
+        # contributing to a touched conversation is re-read to rebuild it whole.
+        changed_keys = {rel_path: set(map(conversation_key, scan_conversation_ids(filepaths[rel_path]))) for rel_path in changed}
+        touched = {key for key, entry in conversations.items() if set(entry['files']) & changed.keys()}
+        touched.update(*changed_keys.values())
+        related = {rel_path for key in touched for rel_path in conversations.get(key, {}).get('files', [])}
+        to_parse = sorted((changed.keys() | related) & filepaths.keys())
+
+        key_files = defaultdict(list)
+        for key in touched & conversations.keys():
+            for rel_path in conversations[key]['files']:
+                if rel_path in filepaths and rel_path not in changed:
+                    key_files[key].append(rel_path)
+        for rel_path, keys in changed_keys.items():
+            for key in keys:
+                key_files[key].append(rel_path)
+        for rel_paths in key_files.values():
+            rel_paths.sort()
+
+        num_indexed = 0
+        pending = []
+        partial = defaultdict(list)
+        parsed = parse_slack_xmls([filepaths[rel_path] for rel_path in to_parse], workers)
+        for rel_path, (_, file_conversations) in zip(to_parse, parsed):
+            for conv_id, text in file_conversations.items():
+                key = conversation_key(conv_id)
+                # A related file also holds untouched conversations, and only part of their sources was read.
+                if key not in touched:
+                    continue
+                sources = key_files.get(key) or [rel_path]
+                if len(sources) > 1:
+                    partial[key].append(text)
+                    if rel_path != sources[-1]:
+                        continue
+                    text = "".join(partial.pop(key))
+                digest = content_hash(text)
+                previous = conversations.get(key)
+                if previous and previous['hash'] == digest:
+                    previous['files'] = sources
+                    continue
+                pending.append((key, digest, sources, to_document(conv_id, text)))
+                if len(pending) >= batch_size:
+                    num_indexed += self._index_pending(pending)
+                    pending = []
+        num_indexed += self._index_pending(pending)
+        if num_indexed:
+            self._commit()
+
+        files.update(changed)
+        self._save_manifest()
+        return num_indexed
+
+    def _index_pending(self, pending):
+        if not pending:
+            return 0
+        conversations = self.manifest['conversations']
+        tombstones = set(self.manifest['tombstones'])
+        next_row = len(self.documents)
+        for offset, (key, digest, sources, _) in enumerate(pending):
+            previous = conversations.get(key)
+            if previous:
+                tombstones.add(previous['row'])
+            conversations[key] = {'hash': digest, 'row': next_row + offset, 'files': sources}
+        self._append([document for _, _, _, document in pending])
+        self.manifest['tombstones'] = sorted(tombstones)
+        self._tombstone_selector = None
+        self._chunk_tombstones = None
+        self._postings = {}
+        return len(pending)
+
+    def _search_params(self, selector=None):
+        if selector is None and self.manifest['tombstones']:
+            if self._tombstone_selector is None:
+                batch = faiss.IDSelectorBatch(self._tombstoned_chunks())
+                self._tombstone_selector = (batch, faiss.IDSelectorNot(batch))
+            selector = self._tombstone_selector[1]
+        return search_params(self.indexes, self.index_params, selector, ef_search=self.ef_search, nprobe=self.nprobe)
+
+    def _tombstoned_chunks(self):
+        # Replacing a conversation tombstones its document row, which retires every chunk of that row.
+        if self._chunk_tombstones is None:
+            self._chunk_tombstones = self.chunks.rows_for_parents(self.manifest['tombstones'])
+        return self._chunk_tombstones
+
+    def _rows_for_filters(self, filters):
+        rows = None
+        for column, value in filters.items():
+            if column not in METADATA_COLUMNS:
+                raise ValueError(f"Unknown filter field '{column}', expected one of {METADATA_COLUMNS}")
+            # Inverted index from metadata value to row ids, built once per value from the interned codes.
+            if (column, value) not in self._postings:
+                code = self.documents.code(column, value)
+                postings = np.flatnonzero(self.documents.codes(column) == code) if code is not None else np.zeros(0, dtype=np.int64)
+                self._postings[(column, value)] = postings.astype(np.int64)
+            postings = self._postings[(column, value)]
+            rows = postings if rows is None else np.intersect1d(rows, postings, assume_unique=True)
+        if self.manifest['tombstones']:
+            rows = np.setdiff1d(rows, np.array(self.manifest['tombstones'], dtype=np.int64), assume_unique=True)
+        return rows
+
+    def _search_filtered(self, embeddings, k, filters):
+        rows = self.chunks.rows_for_parents(self._rows_for_filters(filters))
+        if len(rows) == 0:
+            return np.zeros((len(embeddings), 0), dtype=np.float32), np.zeros((len(embeddings), 0), dtype=np.int64)
+        if len(rows) <= self.exact_filter_threshold:
+            # Small partitions are scanned exactly: cheaper than steering HNSW through a sparse selector, and no recall loss.
+            vectors = self.indexes.reconstruct_batch(rows)
+            distances = np.maximum(
+                (embeddings ** 2).sum(axis=1, keepdims=True) - 2 * embeddings @ vectors.T + (vectors ** 2).sum(axis=1), 0
+            )
+            top = np.argsort(distances, axis=1)[:, :k]
+            return np.take_along_axis(distances, top, axis=1), rows[top]
+        selector = faiss.IDSelectorBatch(rows)
+        return self.indexes.search(embeddings, k, params=self._search_params(selector))
+
+    def _append(self, documents):
+        if self.read_only:
+            raise RuntimeError(f"{self.db_path} is opened read-only; build the index offline with ingest.py")
+        parents, starts, ends, text = [], [], [], []
+        for offset, document in enumerate(documents):
+            for start, end in chunk_spans(document['text'], self.chunk_words, self.chunk_overlap_words):
+                parents.append(len(self.documents) + offset)
+                starts.append(start)
+                ends.append(end)
+                text.append(parse_text({'text': document['text'][start:end]}))
+        embeddings = np.array(self.embed_model.embed(text, progress_path=self.embed_progress_path, keep_in_memory=False), dtype=np.float32)
+        if self.indexes is None:
+            # The backend and its training sample are chosen from the whole first build, so vectors wait on disk until commit.
+            os.makedirs(self.db_path, exist_ok=True)
+            with open(self.staged_embeddings_path, 'ab') as f:
+                embeddings.tofile(f)
+        else:
+            self.indexes.add(embeddings)
+        self.chunks.append(parents, starts, ends)
+        self._chunk_tombstones = None
+        self.documents.append(documents)
+        self._postings = {}
+
+    def _commit(self):
+        if self.indexes is None and os.path.exists(self.staged_embeddings_path) and not os.path.getsize(self.staged_embeddings_path):
+            # Nothing was staged (no document produced a chunk); a zero-length file cannot be memory-mapped.
+            os.remove(self.staged_embeddings_path)
+        if self.indexes is None and os.path.exists(self.staged_embeddings_path):
+            staged = np.memmap(self.staged_embeddings_path, dtype=np.float32, mode='r').reshape(-1, self.dim)
+            self._create_index(staged)
+            for start in range(0, len(staged), 65536):
+                self.indexes.add(np.ascontiguousarray(staged[start:start+65536]))
+            del staged
+            os.remove(self.staged_embeddings_path)
+        # Postings are merged once per commit rather than once per batch.
+        if len(self.lexical) < len(self.documents):
+            self.lexical.add(self.documents.text(row) for row in range(len(self.lexical), len(self.documents)))
         self._save_to_disk()
 
-    def query(self, query, k = 3):
-        embedding = np.array(self.embed_model.embed([query]), dtype=np.float32)
-        distances, indices = self.indexes.search(embedding.reshape(1, -1), k)
+    def index(self, documents):
+        if not documents:
+            return
+        self._append(documents)
+        self._commit()
+
+    @property
+    def version(self):
+        # Rows are append-only and replacements tombstone the old row, so these two counts change on every corpus update.
+        return f"{len(self.documents)}-{len(self.manifest['tombstones'])}"
+
+    async def _aembed_query(self, query):
+        return np.array(await self.embed_model.aembed([query]), dtype=np.float32).reshape(-1)
+
+    async def aembed_query(self, query):
+        # Safety, routing, retrieval and the answer cache all ask for the same text; concurrent and repeat calls share one request.
+        start = time.perf_counter()
+        future = self._query_embeddings.get(query)
+        if future is None or future.get_loop() is not asyncio.get_running_loop() or (
+                future.done() and (future.cancelled() or future.exception() is not None)):
+            CACHE_REQUESTS.inc(cache="query_embedding", result="miss")
+            future = asyncio.ensure_future(self._aembed_query(query))
+            self._query_embeddings[query] = future
+            while len(self._query_embeddings) > self.query_cache_entries:
+                self._query_embeddings.popitem(last=False)
+        else:
+            CACHE_REQUESTS.inc(cache="query_embedding", result="hit")
+            self._query_embeddings.move_to_end(query)
+        try:
+            return await asyncio.shield(future)
+        finally:
+            EMBEDDING_SECONDS.observe(time.perf_counter() - start)
+
+    def nearest_similarity(self, embedding):
+        self.ensure_loaded()
+        rows, scores, _ = self._vector_candidates(np.asarray(embedding, dtype=np.float32).reshape(1, -1), 1)
+        return float(scores[0]) if len(rows) else None
+
+    def _check_mode(self, mode):
+        mode = mode or self.retrieval_mode
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode '{mode}', expected one of {RETRIEVAL_MODES}")
+        return mode
+
+    def _vector_k(self, k, mode):
+        return k if mode == 'vector' else max(k, self.fusion_candidates)
+
+    def query(self, query, k = 3, filters: dict = None, mode: str = None, embedding = None):
+        embeddings = None if embedding is None else np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        return self.query_batch([query], k, filters, mode, embeddings)[0]
+
+    def query_batch(self, queries, k = 3, filters: dict = None, mode: str = None, embeddings = None):
+        mode = self._check_mode(mode)
+        self.ensure_loaded()
+        if self.indexes is None:
+            return [[] for _ in queries]
+        lexical = [None] * len(queries)
+        if mode in ('lexical', 'hybrid'):
+            lexical = [self._lexical_candidates(query, k, filters) for query in queries]
+        vector = [None] * len(queries)
+        if mode in ('vector', 'hybrid'):
+            if embeddings is None:
+                with EMBEDDING_SECONDS.time():
+                    embeddings = self.embed_model.embed(queries)
+            embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(queries), -1)
+            vector = self._vector_candidates_batch(embeddings, self._vector_k(k, mode), filters)
+        return self._batch_results(queries, k, mode, vector, lexical, filters, embeddings)
+
+    async def aquery(self, query, k = 3, filters: dict = None, mode: str = None, embedding = None):
+        embeddings = None if embedding is None else np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        return (await self.aquery_batch([query], k, filters, mode, embeddings))[0]
+
+    async def aquery_batch(self, queries, k = 3, filters: dict = None, mode: str = None, embeddings = None):
+        mode = self._check_mode(mode)
+        await self.aensure_loaded()
+        if self.indexes is None:
+            return [[] for _ in queries]
+        lexical_task = None
+        if mode in ('lexical', 'hybrid'):
+            # Lexical scoring runs on a worker thread while the query embeddings are in flight.
+            lexical_task = asyncio.create_task(asyncio.to_thread(
+                lambda: [self._lexical_candidates(query, k, filters) for query in queries]
+            ))
+        vector = [None] * len(queries)
+        if mode in ('vector', 'hybrid'):
+            if embeddings is None and len(queries) == 1:
+                embeddings = await self.aembed_query(queries[0])
+            elif embeddings is None:
+                with EMBEDDING_SECONDS.time():
+                    embeddings = await self.embed_model.aembed(queries)
+            embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(queries), -1)
+            if len(queries) == 1:
+                # A lone query is cheaper inline than the thread hop.
+                vector = self._vector_candidates_batch(embeddings, self._vector_k(k, mode), filters)
+            else:
+                vector = await asyncio.to_thread(self._vector_candidates_batch, embeddings, self._vector_k(k, mode), filters)
+        lexical = await lexical_task if lexical_task else [None] * len(queries)
+        return self._batch_results(queries, k, mode, vector, lexical, filters, embeddings)
+
+    def _batch_results(self, queries, k, mode, vector, lexical, filters, embeddings):
+        embeddings = [None] * len(queries) if embeddings is None else embeddings
+        return [
+            self._results(query, k, mode, query_vector, query_lexical, filters, embedding)
+            for query, query_vector, query_lexical, embedding in zip(queries, vector, lexical, embeddings)
+        ]
+
+    def _vector_candidates(self, embedding, k, filters=None):
+        return self._vector_candidates_batch(np.asarray(embedding, dtype=np.float32).reshape(1, -1), k, filters)[0]
+
+    def _vector_candidates_batch(self, embeddings, k, filters=None):
+        if self.indexes is None:
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32), {}) for _ in embeddings]
+        # Over-fetch chunks, then keep each conversation once, scored by its best chunk (max-sim).
+        num_chunks = k * self.chunk_overfetch
+        kind = "vector_filtered" if filters else "vector"
+        SEARCH_BATCH_SIZE.observe(len(embeddings), kind=kind)
+        # One search over the whole N x d matrix; FAISS spreads the queries over its OpenMP threads.
+        with SEARCH_SECONDS.time(kind=kind if len(embeddings) == 1 else f"{kind}_batch"):
+            if filters:
+                distances, indices = self._search_filtered(embeddings, num_chunks, filters)
+            else:
+                distances, indices = self.indexes.search(embeddings, num_chunks, params=self._search_params())
+        return [self._group_chunks(row_distances, row_indices, k) for row_distances, row_indices in zip(distances, indices)]
+
+    def _group_chunks(self, distances, indices, k):
+        keep = indices >= 0
+        chunk_rows, similarities = indices[keep], 1.0/(1.0+distances[keep])
+        parents = self.chunks.parents[chunk_rows]
+        rows, first = np.unique(parents, return_index=True)
+        order = np.argsort(first, kind='stable')[:k]
+        hits = defaultdict(list)
+        for chunk_row, parent in zip(chunk_rows.tolist(), parents.tolist()):
+            if len(hits[parent]) < self.max_chunks_per_result:
+                hits[parent].append(chunk_row)
+        return rows[order], similarities[first[order]], hits
+
+    def _lexical_candidates(self, query, k, filters=None):
+        k = max(k, self.fusion_candidates)
+        with SEARCH_SECONDS.time(kind="lexical"):
+            if filters:
+                return self.lexical.search(query, k, allowed_rows=self._rows_for_filters(filters))
+            return self.lexical.search(query, k, excluded_rows=np.array(self.manifest['tombstones'], dtype=np.int64))
+
+    def _fuse(self, *candidates):
+        scores = defaultdict(float)
+        for rows, *_ in candidates:
+            for rank, row in enumerate(rows):
+                scores[int(row)] += 1.0/(self.rrf_k + rank + 1)
+        fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return [row for row, _ in fused], [score for _, score in fused]
+
+    def _best_chunks(self, row, embedding, query):
+        # Conversations found only lexically: pick their chunks closest to the query embedding, else by term overlap.
+        chunk_rows = self.chunks.rows_for_parents([row])
+        if len(chunk_rows) <= self.max_chunks_per_result:
+            return chunk_rows.tolist()
+        if embedding is not None:
+            distances = ((self.indexes.reconstruct_batch(chunk_rows) - embedding.reshape(1, -1)) ** 2).sum(axis=1)
+            order = np.argsort(distances)
+        else:
+            terms = set(tokenize(query))
+            text = self.documents.text(row)
+            overlap = [len(terms.intersection(tokenize(text[slice(*self.chunks.span(chunk_row, text))]))) for chunk_row in chunk_rows]
+            order = np.argsort(-np.array(overlap), kind='stable')
+        return chunk_rows[order[:self.max_chunks_per_result]].tolist()
+
+    def _chunk_text(self, text, chunk_rows):
+        spans = merge_spans(self.chunks.span(chunk_row, text) for chunk_row in chunk_rows)
+        return "\n...\n".join(text[start:end] for start, end in spans)
+
+    def _results(self, query, k, mode, vector, lexical, filters=None, embedding=None):
+        if mode == 'hybrid':
+            rows, scores = self._fuse(vector, lexical)
+        else:
+            rows, scores = vector[:2] if mode == 'vector' else lexical
+        hits = vector[2] if vector is not None else {}
         results = []
         retrieved_docs = []
-        for idx, dist in zip(indices[0], distances[0]):
-            if idx >=0:
-                document = self.documents[idx]
-                retrieved_docs.append(document['id'])
-                result = {
-                    'id': document['id'],
-                    'text': document['text'],
-                    'metadata': document['metadata'],
-                    'score': float(1.0/(1.0+dist))
-                }
-                results.append(result)
-
-        self.query_log.append({
-            "query": query,
-            "retrieved_ids": retrieved_docs,
-        })
-        return results
\ No newline at end of file
+        for idx, score in zip(list(rows)[:k], list(scores)[:k]):
+            document = self.documents[int(idx)]
+            retrieved_docs.append(document['id'])
+            chunk_rows = hits.get(int(idx)) or self._best_chunks(int(idx), embedding, query)
+            result = {
+                'id': document['id'],
+                # Only the matching chunks go to the chat model, not the whole thread.
+                'text': self._chunk_text(document['text'], chunk_rows),
+                'metadata': document['metadata'],
+                'score': float(score)
+            }
+            results.append(result)
+
+        if self.query_log is not None:
+            self.query_log.record({
+                "ts": time.time(),
+                "query": query,
+                "mode": mode,
+                "filters": filters or {},
+                "retrieved_ids": retrieved_docs,
+                "scores": [result['score'] for result in results],
+                # Fused scores are rank-based, so the best raw vector similarity is logged separately for gap analysis.
+                "top_vector_similarity": float(vector[1][0]) if vector is not None and len(vector[1]) else None,
+                "index_version": self.version,
+            })
+        return results
+
+class QueryBatcher:
+    """Coalesces concurrent queries that share k, mode and filters into one aquery_batch call per short window."""
+    def __init__(self, vector_search: VectorSearch, window_seconds: float = 0.003, max_batch_size: int = 32):
+        self.vector_search = vector_search
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._pending = {}
+        self._tasks = set()
+
+    async def query(self, query, k = 3, filters: dict = None, mode: str = None, embedding = None):
+        mode = self.vector_search._check_mode(mode)
+        if embedding is None and mode != 'lexical':
+            embedding = await self.vector_search.aembed_query(query)
+        key = (k, mode, tuple(sorted((filters or {}).items())))
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            loop.call_later(self.window_seconds, self._flush, key, batch)
+        batch.append((query, embedding, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key, batch):
+        # The window timer and the size trigger can both fire for one batch; only the first one runs it.
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        task = asyncio.ensure_future(self._run(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, batch):
+        k, mode, filters = key
+        queries = [query for query, _, _ in batch]
+        embeddings = None
+        if mode != 'lexical':
+            embeddings = np.stack([np.asarray(embedding, dtype=np.float32).reshape(-1) for _, embedding, _ in batch])
+        try:
+            results = await self.vector_search.aquery_batch(queries, k, dict(filters) or None, mode, embeddings)
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, _, future), result in zip(batch, results):
+            # Waiters whose request was cancelled have already given up on their future.
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
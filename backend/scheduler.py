@@ -0,0 +1,170 @@
+import json
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+
+import httpx
+from groq import DefaultAsyncHttpxClient
+from pydantic import ValidationError
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt
+
+from metrics import SCHEDULER_WAIT_SECONDS
+
+# Lower runs first: user-facing streaming is served before background compression.
+PRIORITIES = {'interactive': 0, 'background': 1}
+
+class Overloaded(Exception):
+    pass
+
+class PrioritySemaphore:
+    """Semaphore whose waiters are woken lowest priority value first, FIFO within a priority."""
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    async def acquire(self, priority: int = 0):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Woken and cancelled in the same tick: hand the slot on instead of leaking it.
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    async def acquire(self, amount: float = 1):
+        # Reserve first and sleep off the debt after, so no waiter holds anything the others queue behind.
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return
+        try:
+            await asyncio.sleep(-self.tokens / self.rate_per_second)
+        except asyncio.CancelledError:
+            self.tokens += amount
+            raise
+
+class UpstreamScheduler:
+    """Per-model concurrency and rate limits for Groq calls, plus one pooled HTTP client shared by every agent."""
+    def __init__(self, models: dict = None, default: dict = None, max_connections: int = 100,
+                 max_keepalive_connections: int = 20, request_timeout_seconds: float = 60):
+        self.models = models or {}
+        self.default = default or {'max_concurrency': 8, 'requests_per_minute': 30}
+        self.http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+            timeout=httpx.Timeout(request_timeout_seconds, connect=5.0)
+        )
+        self._limits = {}
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(
+            models=config.get('models'),
+            default=config.get('default'),
+            max_connections=config.get('max_connections', 100),
+            max_keepalive_connections=config.get('max_keepalive_connections', 20),
+            request_timeout_seconds=config.get('request_timeout_seconds', 60)
+        )
+
+    def _limits_for(self, model_id):
+        if model_id not in self._limits:
+            limits = {**self.default, **self.models.get(model_id, {})}
+            requests_per_minute = limits.get('requests_per_minute')
+            bucket = None
+            if requests_per_minute:
+                bucket = TokenBucket(requests_per_minute / 60, limits.get('burst', max(1, limits['max_concurrency'])))
+            self._limits[model_id] = (PrioritySemaphore(limits['max_concurrency']), bucket)
+        return self._limits[model_id]
+
+    @asynccontextmanager
+    async def slot(self, model_id: str, priority: str = 'interactive'):
+        semaphore, bucket = self._limits_for(model_id)
+        start = time.perf_counter()
+        await semaphore.acquire(PRIORITIES[priority])
+        try:
+            if bucket is not None:
+                await bucket.acquire()
+            SCHEDULER_WAIT_SECONDS.observe(time.perf_counter() - start, model=model_id, priority=priority)
+            yield
+        finally:
+            semaphore.release()
+
+    def retrying(self, model_id: str, attempts: int = 3):
+        """instructor retry policy for a call made inside slot(): each re-ask after the first takes its own rate token."""
+        _, bucket = self._limits_for(model_id)
+        async def charge(retry_state):
+            if bucket is not None and retry_state.attempt_number > 1:
+                await bucket.acquire()
+        return AsyncRetrying(
+            stop=stop_after_attempt(attempts),
+            retry=retry_if_exception_type((ValidationError, json.JSONDecodeError)),
+            before=charge,
+            reraise=True
+        )
+
+    async def aclose(self):
+        await self.http_client.aclose()
+
+class AdmissionController:
+    """Bounded entry queue for /chat: excess requests are shed immediately instead of piling onto upstream limits."""
+    def __init__(self, max_concurrent_requests: int = 32, max_queued_requests: int = 64, queue_timeout_seconds: float = 2.0):
+        self.max_queued_requests = max_queued_requests
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self._semaphore = asyncio.Semaphore(max_concurrent_requests)
+        self._queued = 0
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(
+            max_concurrent_requests=config.get('max_concurrent_requests', 32),
+            max_queued_requests=config.get('max_queued_requests', 64),
+            queue_timeout_seconds=config.get('queue_timeout_seconds', 2.0)
+        )
+
+    async def acquire(self):
+        if self._semaphore.locked() and self._queued >= self.max_queued_requests:
+            raise Overloaded("Request queue is full")
+        self._queued += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            raise Overloaded("Timed out waiting for a free request slot")
+        finally:
+            self._queued -= 1
+
+    def release(self):
+        self._semaphore.release()
+
+    def releaser(self):
+        """Release callback that frees the slot once however many of a request's exit paths call it."""
+        released = False
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.release()
+        return release
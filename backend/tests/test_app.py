@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from scheduler import AdmissionController
+
+def chat_scope(spec_version):
+    return {
+        'type': 'http', 'asgi': {'version': '3.0', 'spec_version': spec_version}, 'http_version': '1.1',
+        'method': 'POST', 'scheme': 'http', 'path': '/chat', 'raw_path': b'/chat', 'root_path': '', 'query_string': b'',
+        'headers': [(b'content-type', b'application/json')], 'client': ('test', 1), 'server': ('test', 80),
+    }
+
+def disconnecting_receive():
+    messages = [{'type': 'http.request', 'body': json.dumps({'user_query': 'hi'}).encode(), 'more_body': False}]
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+    return receive
+
+class AdmissionReleaseTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.previous = app.admission
+        app.admission = AdmissionController(max_concurrent_requests=1, max_queued_requests=0, queue_timeout_seconds=0.1)
+
+    async def asyncTearDown(self):
+        app.admission = self.previous
+
+    async def assert_slot_free(self):
+        await app.admission.acquire()
+        app.admission.release()
+
+    async def test_disconnect_before_first_chunk_releases_slot(self):
+        # ASGI 2.4 servers report the disconnect by failing the first send.
+        async def send(message):
+            raise OSError("client went away")
+        try:
+            await app.app(chat_scope('2.4'), disconnecting_receive(), send)
+        except Exception:
+            pass
+        await self.assert_slot_free()
+
+    async def test_disconnect_while_waiting_to_send_releases_slot(self):
+        # Older servers: the disconnect listener cancels the stream before the body is iterated.
+        async def send(message):
+            await asyncio.Event().wait()
+        await app.app(chat_scope('2.3'), disconnecting_receive(), send)
+        await self.assert_slot_free()
+
+    async def test_shed_request_gets_503(self):
+        await app.admission.acquire()
+        sent = []
+        async def send(message):
+            sent.append(message)
+        await app.app(chat_scope('2.4'), disconnecting_receive(), send)
+        app.admission.release()
+        self.assertEqual(sent[0]['status'], 503)
+        await self.assert_slot_free()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_packer import ContextPacker, estimate_tokens
+
+def document(doc_id, text):
+    return {'id': doc_id, 'text': text, 'metadata': {}}
+
+def filler(topic, count):
+    return "\n".join(f"Sentence {number} mentions {topic} and nothing of interest {number}." for number in range(count))
+
+class ContextPackerTest(unittest.TestCase):
+    def packer(self, budget_tokens):
+        return ContextPacker(budget_tokens=budget_tokens, tokenizer='heuristic')
+
+    def packed_tokens(self, packed):
+        return sum(estimate_tokens(line) for result in packed for line in result['text'].split("\n") if line != "...")
+
+    def test_small_passages_are_kept_whole(self):
+        documents = [document('a', "How do I close a channel?"), document('b', "Call close! on it.")]
+        self.assertEqual(self.packer(1000).pack("close channel", documents), documents)
+
+    def test_stays_within_the_budget(self):
+        documents = [document(str(number), filler(f"topic{number}", 40)) for number in range(3)]
+        for budget in (50, 200, 600):
+            with self.subTest(budget=budget):
+                packed = self.packer(budget).pack("channel", documents)
+                self.assertLessEqual(self.packed_tokens(packed), budget)
+
+    def test_trimming_keeps_query_sentences(self):
+        text = filler("weather", 30) + "\nUse core.async/close! to close the channel.\n" + filler("lunch", 30)
+        (packed,) = self.packer(60).pack("how to close a core.async channel", [document('a', text)])
+        self.assertIn("Use core.async/close! to close the channel.", packed['text'])
+        self.assertNotIn("weather", packed['text'])
+
+    def test_short_passages_leave_their_share_to_long_ones(self):
+        documents = [document('short', "Tiny answer."), document('long', filler("channel", 40))]
+        short, long = self.packer(100).pack("channel", documents)
+        self.assertEqual(short['text'], "Tiny answer.")
+        self.assertGreater(estimate_tokens(long['text']), 50)
+
+    def test_near_duplicates_are_dropped(self):
+        text = filler("channel", 10)
+        packed = self.packer(1000).pack("channel", [document('a', text), document('b', text + "\nOne more line.")])
+        self.assertEqual([result['id'] for result in packed], ['a'])
+
+    def test_repeated_sentences_appear_once(self):
+        quoted = "Close the channel when the producer is done."
+        packed = self.packer(1000).pack("channel", [
+            document('a', f"{quoted}\nThat is what the docs say."), document('b', f"Someone quoted:\n{quoted}\nand asked why.")
+        ])
+        self.assertEqual(sum(result['text'].count(quoted) for result in packed), 1)
+
+if __name__ == '__main__':
+    unittest.main()
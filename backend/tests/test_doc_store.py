@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from doc_store import ChunkStore, DocStore
+
+def document(doc_id, text, channel='chan'):
+    return {'id': doc_id, 'text': text, 'metadata': {'team_domain': 'team', 'channel_name': channel}}
+
+class DocStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'doc_store')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_rows_read_back_after_reopening(self):
+        store = DocStore(self.path)
+        store.append([document('a', 'first thread'), document('b', 'zweiter Faden ✓', channel='other')])
+        store.append([document('c', '')])
+        reopened = DocStore(self.path)
+        self.assertEqual(len(reopened), 3)
+        self.assertEqual(reopened[1], document('b', 'zweiter Faden ✓', channel='other'))
+        self.assertEqual(reopened[-1]['text'], '')
+        self.assertEqual([row['id'] for row in reopened], ['a', 'b', 'c'])
+        with self.assertRaises(IndexError):
+            reopened[3]
+
+    def test_metadata_is_interned(self):
+        store = DocStore(self.path)
+        store.append([document('a', 'x'), document('b', 'y', channel='other'), document('c', 'z')])
+        code = store.code('channel_name', 'chan')
+        self.assertEqual(store.codes('channel_name').tolist(), [code, store.code('channel_name', 'other'), code])
+        self.assertIsNone(store.code('channel_name', 'missing'))
+
+    def test_truncate_then_append_overwrites_dropped_rows(self):
+        store = DocStore(self.path)
+        store.append([document('a', 'kept'), document('b', 'dropped')])
+        store.truncate(1)
+        store.append([document('c', 'new')])
+        reopened = DocStore(self.path)
+        self.assertEqual([row['text'] for row in reopened], ['kept', 'new'])
+
+    def test_chunks_map_back_to_parents(self):
+        chunks = ChunkStore(os.path.join(self.tmp.name, 'chunks'))
+        chunks.append([0, 0, 1], [0, 5, 0], [8, 12, 4])
+        self.assertEqual(chunks.rows_for_parents([0]).tolist(), [0, 1])
+        self.assertEqual(chunks.span(1, 'some text here'), (5, 12))
+
+if __name__ == '__main__':
+    unittest.main()
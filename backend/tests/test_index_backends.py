@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import faiss
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_backends import INDEX_TYPES, build_index, default_index_params, read_index
+
+class ReadIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.vectors = np.random.default_rng(0).standard_normal((2048, 32)).astype(np.float32)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, index_type):
+        params = default_index_params(index_type, 32, len(self.vectors))
+        index = build_index(params, self.vectors)
+        index.add(self.vectors)
+        path = os.path.join(self.tmp.name, f'{index_type}.faiss')
+        faiss.write_index(index, path)
+        return path
+
+    def test_every_backend_memory_maps(self):
+        for index_type in INDEX_TYPES:
+            with self.subTest(index_type=index_type):
+                path = self.write(index_type)
+                with mock.patch.object(faiss, 'read_index', wraps=faiss.read_index) as patched:
+                    with self.assertNoLogs('index_backends', level='WARNING'):
+                        index = read_index(path, mmap=True)
+                self.assertEqual(patched.call_count, 1)
+                self.assertTrue(patched.call_args.args[1] & faiss.IO_FLAG_READ_ONLY)
+                self.assertEqual(index.ntotal, len(self.vectors))
+                np.testing.assert_allclose(index.reconstruct(7), read_index(path).reconstruct(7), rtol=1e-5)
+
+    def test_ivf_pq_falls_back_to_lists_mmap(self):
+        path = self.write('ivf_pq')
+        real_read = faiss.read_index
+        def read(path, flags=0):
+            if flags & faiss.IO_FLAG_MMAP_IFC:
+                raise RuntimeError("mmap only supported for File objects")
+            return real_read(path, flags)
+        with mock.patch.object(faiss, 'read_index', side_effect=read) as patched:
+            with self.assertLogs('index_backends', level='WARNING') as logs:
+                index = read_index(path, mmap=True)
+        self.assertEqual(len(logs.records), 1)
+        self.assertTrue(patched.call_args.args[1] & faiss.IO_FLAG_MMAP)
+        self.assertEqual(index.ntotal, len(self.vectors))
+
+    def test_full_read_when_mmap_fails(self):
+        path = self.write('flat')
+        real_read = faiss.read_index
+        def read(path, flags=0):
+            if flags:
+                raise RuntimeError("mmap not supported")
+            return real_read(path)
+        with mock.patch.object(faiss, 'read_index', side_effect=read):
+            with self.assertLogs('index_backends', level='WARNING') as logs:
+                index = read_index(path, mmap=True)
+        self.assertIn('into memory', logs.output[-1])
+        self.assertEqual(index.ntotal, len(self.vectors))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import hashlib
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import VectorSearch
+
+class FakeEmbeddingModel:
+    model_id = 'fake'
+
+    def embed(self, text, progress_path=None, keep_in_memory: bool = True):
+        return [np.random.default_rng(int(hashlib.md5(t.encode()).hexdigest()[:8], 16)).standard_normal(768) for t in text]
+
+def write_export(path, messages):
+    body = "".join(
+        f'<message conversation_id="{conv_id}"><ts>0</ts><user>u</user><text>{text}</text></message>'
+        for conv_id, text in messages
+    )
+    with open(path, 'w') as f:
+        f.write(f"<slack><team_domain>team</team_domain><channel_name>chan</channel_name>{body}</slack>")
+
+def live_documents(vector_search):
+    tombstones = set(vector_search.manifest['tombstones'])
+    return {document['id']: document['text'] for row, document in enumerate(vector_search.documents) if row not in tombstones}
+
+class IncrementalIngestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmp.name, 'data')
+        os.makedirs(self.data_dir)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def vector_search(self, name):
+        return VectorSearch(db_path=os.path.join(self.tmp.name, name), data_dir=None, embed_model=FakeEmbeddingModel())
+
+    def test_daily_export_keeps_conversations_spanning_unparsed_files(self):
+        # X spans days A and B, Y spans B and C: adding C re-reads B, which must not rebuild X from B alone.
+        write_export(os.path.join(self.data_dir, 'a.xml'), [('X', 'x part one from day A')])
+        write_export(os.path.join(self.data_dir, 'b.xml'), [('X', 'x part two from day B'), ('Y', 'y part one from day B')])
+        incremental = self.vector_search('incremental')
+        incremental.ingest(self.data_dir)
+        write_export(os.path.join(self.data_dir, 'c.xml'), [('Y', 'y part two from day C')])
+        self.assertEqual(incremental.ingest(self.data_dir), 1)
+
+        from_scratch = self.vector_search('from_scratch')
+        from_scratch.ingest(self.data_dir)
+        self.assertEqual(live_documents(incremental), live_documents(from_scratch))
+        self.assertEqual(live_documents(incremental)['X'], "x part one from day A\nx part two from day B\n")
+        conversations = incremental.manifest['conversations']
+        self.assertEqual(conversations['team/chan/X']['files'], ['a.xml', 'b.xml'])
+        self.assertEqual(conversations['team/chan/Y']['files'], ['b.xml', 'c.xml'])
+
+    def test_unchanged_files_are_not_reindexed(self):
+        write_export(os.path.join(self.data_dir, 'a.xml'), [('X', 'x from day A'), ('Y', 'y from day A')])
+        vector_search = self.vector_search('db')
+        self.assertEqual(vector_search.ingest(self.data_dir), 2)
+        self.assertEqual(vector_search.ingest(self.data_dir), 0)
+
+    def test_indexing_nothing_on_a_fresh_store(self):
+        vector_search = self.vector_search('db')
+        vector_search.index([])
+        self.assertFalse(os.path.exists(vector_search.staged_embeddings_path))
+        vector_search.index([{'id': 'X', 'text': 'x from day A', 'metadata': {'team_domain': 'team', 'channel_name': 'chan'}}])
+        self.assertEqual(live_documents(vector_search), {'X': 'x from day A'})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_gaps import aggregate_queries
+
+class AggregateQueriesTest(unittest.TestCase):
+    def test_zero_timestamp_is_kept(self):
+        records = [
+            {'query': 'How do I  unpack?', 'ts': 5, 'top_vector_similarity': 0.1},
+            {'query': 'how do i unpack?', 'ts': 0, 'top_vector_similarity': 0.2},
+            {'query': 'how do i unpack?', 'ts': 3, 'top_vector_similarity': 0.3},
+        ]
+        (query,) = aggregate_queries(records, min_similarity=0.5)
+        self.assertEqual(query['count'], 3)
+        self.assertEqual((query['first_seen'], query['last_seen']), (0, 5))
+
+    def test_answered_queries_are_skipped(self):
+        records = [
+            {'query': 'well covered', 'ts': 1, 'top_vector_similarity': 0.9},
+            {'query': 'lexical hit', 'ts': 1, 'top_vector_similarity': None, 'retrieved_ids': ['1']},
+            {'query': 'lexical miss', 'ts': 1, 'top_vector_similarity': None, 'retrieved_ids': []},
+        ]
+        self.assertEqual([query['text'] for query in aggregate_queries(records, min_similarity=0.5)], ['lexical miss'])
+
+if __name__ == '__main__':
+    unittest.main()
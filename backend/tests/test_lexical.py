@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexical import BM25Index, tokenize
+
+TEXTS = [
+    "How do I close a core.async channel?",
+    "Use clojure.string/join to join strings",
+    "The channel is closed after the go block returns; the channel then yields nil",
+    "Nothing relevant here at all",
+]
+
+class TokenizeTest(unittest.TestCase):
+    def test_identifiers_are_kept_whole_and_split(self):
+        self.assertEqual(tokenize("Is core.async fast?"), ['core.async', 'core', 'async', 'fast'])
+        self.assertEqual(tokenize("&lt;java.lang.NullPointerException&gt;")[:1], ['java.lang.nullpointerexception'])
+
+class BM25IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index = BM25Index(os.path.join(self.tmp.name, 'bm25'))
+        self.index.add(TEXTS)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_ranks_by_term_weight(self):
+        rows, scores = self.index.search("channel", k=10)
+        self.assertEqual(sorted(rows.tolist()), [0, 2])
+        self.assertTrue(all(scores[:-1] >= scores[1:]))
+        self.assertEqual(self.index.search("core.async", k=1)[0].tolist(), [0])
+
+    def test_row_restrictions(self):
+        self.assertEqual(self.index.search("channel", k=10, allowed_rows=[2])[0].tolist(), [2])
+        self.assertEqual(self.index.search("channel", k=10, excluded_rows=[0])[0].tolist(), [2])
+        self.assertEqual(len(self.index.search("unseen words", k=10)[0]), 0)
+
+    def test_saved_generations_reload_and_append(self):
+        self.index.save()
+        reopened = BM25Index(os.path.join(self.tmp.name, 'bm25'), mmap=True)
+        self.assertEqual(len(reopened), len(TEXTS))
+        reopened.add(["a brand new channel thread"])
+        reopened.save()
+        rows, _ = BM25Index(os.path.join(self.tmp.name, 'bm25')).search("brand", k=5)
+        self.assertEqual(rows.tolist(), [4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+from typing import List, TypedDict
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langgraph.graph import END, StateGraph
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents import MemoryCompressionQueue
+from checkpoint_store import open_checkpointer
+
+class State(TypedDict):
+    messages: List[BaseMessage]
+    history: List[str]
+    history_token_counts: List[int]
+    history_tokens: int
+
+def build_test_graph(checkpointer):
+    graph = StateGraph(State)
+    graph.add_node("chat_agent", lambda state: state)
+    graph.set_entry_point("chat_agent")
+    graph.add_edge("chat_agent", END)
+    return graph.compile(checkpointer=checkpointer)
+
+class FakeMemoryAgent:
+    def __init__(self):
+        self.calls = 0
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+    def needs_compression(self, state):
+        return len(state.get("messages", [])) > 2
+
+    async def compress(self, state):
+        self.calls += 1
+        await asyncio.sleep(0)
+        return {"messages": [SystemMessage(content="summary")]}
+
+def turn(number):
+    return [HumanMessage(content=f"question {number}"), AIMessage(content=f"answer {number}")]
+
+class MemoryCompressionQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'checkpoints.sqlite')
+        self.checkpointers = []
+        self.graph = await self.open_graph()
+        self.memory_agent = FakeMemoryAgent()
+        self.queue = MemoryCompressionQueue(self.graph, self.memory_agent, debounce_seconds=0.01)
+        self.config = {"configurable": {"thread_id": "t"}}
+
+    async def asyncTearDown(self):
+        await self.queue.aclose()
+        for checkpointer in self.checkpointers:
+            await checkpointer.conn.close()
+        self.tmp.cleanup()
+
+    async def open_graph(self):
+        # Each graph gets its own connection, like a separate uvicorn worker.
+        checkpointer = await open_checkpointer({'path': self.path})
+        self.checkpointers.append(checkpointer)
+        return build_test_graph(checkpointer)
+
+    async def messages(self):
+        return [message.content for message in (await self.graph.aget_state(self.config)).values["messages"]]
+
+    async def test_keeps_turns_appended_while_summarizing(self):
+        await self.graph.ainvoke({"messages": turn(1) + turn(2)}, self.config)
+        compress = self.memory_agent.compress
+        async def compress_during_turn(state):
+            update = await compress(state)
+            await self.graph.aupdate_state(self.config, {"messages": state["messages"] + turn(3)}, as_node="chat_agent")
+            return update
+        self.memory_agent.compress = compress_during_turn
+        await self.queue._compress("t")
+        self.assertEqual(await self.messages(), ["summary", "question 3", "answer 3"])
+
+    async def test_write_loses_to_another_workers_turn(self):
+        await self.graph.ainvoke({"messages": turn(1) + turn(2)}, self.config)
+        other_worker = await self.open_graph()
+        aget_state = self.graph.aget_state
+        reads = 0
+        async def aget_state_then_other_turn(config, *args, **kwargs):
+            nonlocal reads
+            snapshot = await aget_state(config, *args, **kwargs)
+            reads += 1
+            if reads == 2:
+                # Another worker commits a turn between the re-read and the compression write.
+                await other_worker.aupdate_state(config, {"messages": snapshot.values["messages"] + turn(3)}, as_node="chat_agent")
+            return snapshot
+        self.graph.aget_state = aget_state_then_other_turn
+        await self.queue._compress("t")
+        del self.graph.aget_state
+        self.assertEqual(await self.messages(), [f"{kind} {number}" for number in (1, 2, 3) for kind in ("question", "answer")])
+
+    async def test_debounces_a_burst_into_one_compression(self):
+        await self.graph.ainvoke({"messages": turn(1) + turn(2)}, self.config)
+        runner = asyncio.create_task(self.queue.run())
+        for _ in range(3):
+            self.queue.schedule("t")
+            await asyncio.sleep(0.002)
+        await asyncio.sleep(0.1)
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        self.assertEqual(self.memory_agent.calls, 1)
+        self.assertEqual(await self.messages(), ["summary"])
+
+    async def test_compression_waits_for_a_turn_in_progress(self):
+        await self.graph.ainvoke({"messages": turn(1) + turn(2)}, self.config)
+        async with self.queue.thread_lock("t"):
+            task = asyncio.create_task(self.queue._compress("t"))
+            await asyncio.sleep(0.05)
+            self.assertFalse(task.done())
+            await self.graph.aupdate_state(self.config, {"messages": (await self.graph.aget_state(self.config)).values["messages"] + turn(3)}, as_node="chat_agent")
+        await task
+        self.assertEqual(await self.messages(), ["summary", "question 3", "answer 3"])
+        self.assertEqual(self.queue._thread_locks, {})
+
+if __name__ == '__main__':
+    unittest.main()
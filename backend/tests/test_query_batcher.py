@@ -0,0 +1,75 @@
+import os
+import sys
+import asyncio
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import QueryBatcher
+
+class FakeVectorSearch:
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+
+    def _check_mode(self, mode):
+        return mode or 'vector'
+
+    async def aembed_query(self, query):
+        return np.full(4, len(query), dtype=np.float32)
+
+    async def aquery_batch(self, queries, k, filters, mode, embeddings):
+        self.calls.append((list(queries), k, filters, mode, None if embeddings is None else embeddings.shape))
+        await asyncio.sleep(0)
+        if self.error:
+            raise self.error
+        return [[{'id': query}] for query in queries]
+
+class QueryBatcherTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_queries_share_one_call(self):
+        vector_search = FakeVectorSearch()
+        batcher = QueryBatcher(vector_search, window_seconds=0.01)
+        results = await asyncio.gather(*(batcher.query(f'q{number}', k=2) for number in range(5)))
+        self.assertEqual(results, [[{'id': f'q{number}'}] for number in range(5)])
+        self.assertEqual(len(vector_search.calls), 1)
+        self.assertEqual(vector_search.calls[0][4], (5, 4))
+
+    async def test_batches_split_by_k_mode_and_filters(self):
+        vector_search = FakeVectorSearch()
+        batcher = QueryBatcher(vector_search, window_seconds=0.01)
+        await asyncio.gather(
+            batcher.query('a', k=2), batcher.query('b', k=2),
+            batcher.query('c', k=3),
+            batcher.query('d', k=2, filters={'channel_name': 'beta'}),
+            batcher.query('e', k=2, mode='lexical'),
+        )
+        batches = sorted(call[0] for call in vector_search.calls)
+        self.assertEqual(batches, [['a', 'b'], ['c'], ['d'], ['e']])
+        lexical = next(call for call in vector_search.calls if call[3] == 'lexical')
+        self.assertIsNone(lexical[4])
+
+    async def test_full_batch_flushes_before_the_window(self):
+        vector_search = FakeVectorSearch()
+        batcher = QueryBatcher(vector_search, window_seconds=10, max_batch_size=2)
+        results = await asyncio.wait_for(asyncio.gather(batcher.query('a'), batcher.query('b')), 1)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(vector_search.calls), 1)
+
+    async def test_errors_reach_every_waiter(self):
+        batcher = QueryBatcher(FakeVectorSearch(error=RuntimeError("index gone")), window_seconds=0.01)
+        results = await asyncio.gather(batcher.query('a'), batcher.query('b'), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+
+    async def test_cancelled_waiter_does_not_break_the_batch(self):
+        vector_search = FakeVectorSearch()
+        batcher = QueryBatcher(vector_search, window_seconds=0.01)
+        cancelled = asyncio.create_task(batcher.query('a'))
+        kept = asyncio.create_task(batcher.query('b'))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        self.assertEqual(await kept, [{'id': 'b'}])
+
+if __name__ == '__main__':
+    unittest.main()
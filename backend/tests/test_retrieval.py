@@ -0,0 +1,136 @@
+import os
+import sys
+import hashlib
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import VectorSearch
+
+class FakeEmbeddingModel:
+    model_id = 'fake'
+
+    def embed(self, text, progress_path=None, keep_in_memory: bool = True):
+        return [np.random.default_rng(int(hashlib.md5(t.encode()).hexdigest()[:8], 16)).standard_normal(768) for t in text]
+
+    async def aembed(self, text, keep_in_memory: bool = True):
+        return self.embed(text)
+
+def documents(channel, count):
+    return [
+        {'id': f'{channel}-{number}', 'text': f'{channel} thread {number} about topic {number}',
+         'metadata': {'team_domain': 'team', 'channel_name': channel}}
+        for number in range(count)
+    ]
+
+class FilteredSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.vector_search = self.open(exact_filter_threshold=4096)
+        self.vector_search.index(documents('alpha', 20) + documents('beta', 20))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def open(self, **kwargs):
+        return VectorSearch(db_path=os.path.join(self.tmp.name, 'db'), data_dir=None, embed_model=FakeEmbeddingModel(), **kwargs)
+
+    def alpha_embedding(self):
+        return self.vector_search.indexes.reconstruct(0)
+
+    def test_filter_restricts_results(self):
+        unfiltered = self.vector_search.query('q', k=5, embedding=self.alpha_embedding())
+        self.assertEqual(unfiltered[0]['id'], 'alpha-0')
+        filtered = self.vector_search.query('q', k=5, filters={'channel_name': 'beta'}, embedding=self.alpha_embedding())
+        self.assertEqual(len(filtered), 5)
+        self.assertTrue(all(result['metadata']['channel_name'] == 'beta' for result in filtered))
+
+    def test_exact_and_selector_paths_agree(self):
+        selector_search = self.open(exact_filter_threshold=0)
+        for filters in ({'channel_name': 'beta'}, {'team_domain': 'team', 'channel_name': 'alpha'}):
+            with self.subTest(filters=filters):
+                exact = self.vector_search.query('q', k=5, filters=filters, embedding=self.alpha_embedding())
+                selected = selector_search.query('q', k=5, filters=filters, embedding=self.alpha_embedding())
+                self.assertEqual([result['id'] for result in exact], [result['id'] for result in selected])
+
+    def test_unmatched_filter_returns_nothing(self):
+        self.assertEqual(self.vector_search.query('q', filters={'channel_name': 'gamma'}, embedding=self.alpha_embedding()), [])
+
+    def test_unknown_filter_field_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.vector_search.query('q', filters={'user': 'u'}, embedding=self.alpha_embedding())
+
+class HybridSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.vector_search = VectorSearch(db_path=os.path.join(self.tmp.name, 'db'), data_dir=None,
+                                          embed_model=FakeEmbeddingModel(), rrf_k=60)
+        self.vector_search.index(documents('alpha', 20) + [
+            {'id': 'rare', 'text': 'zzuniqueword explained', 'metadata': {'team_domain': 'team', 'channel_name': 'alpha'}}
+        ])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_reciprocal_rank_fusion(self):
+        rows, scores = self.vector_search._fuse(([1, 2, 3],), ([3, 1],))
+        # Row 1 ranks first and second, row 3 third and first, row 2 appears in one list only.
+        self.assertEqual(rows, [1, 3, 2])
+        self.assertAlmostEqual(scores[0], 1 / 61 + 1 / 62)
+        self.assertAlmostEqual(scores[2], 1 / 62)
+
+    def test_lexical_match_survives_fusion(self):
+        embedding = self.vector_search.indexes.reconstruct(0)
+        vector = [result['id'] for result in self.vector_search.query('zzuniqueword', k=3, mode='vector', embedding=embedding)]
+        hybrid = [result['id'] for result in self.vector_search.query('zzuniqueword', k=3, mode='hybrid', embedding=embedding)]
+        self.assertNotIn('rare', vector)
+        self.assertIn('rare', hybrid)
+        self.assertEqual(self.vector_search.query('zzuniqueword', k=1, mode='lexical')[0]['id'], 'rare')
+
+    def test_unknown_mode_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.vector_search.query('q', mode='semantic')
+
+class HotSwapTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, 'db')
+        self.writer = VectorSearch(db_path=self.db_path, data_dir=None, embed_model=FakeEmbeddingModel())
+        self.writer.index(documents('alpha', 5))
+        self.writer._save_manifest()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def reader(self, **kwargs):
+        return VectorSearch(db_path=self.db_path, data_dir=None, embed_model=FakeEmbeddingModel(), lazy_load=True,
+                            read_only=True, mmap_index=True, **kwargs)
+
+    def test_reader_picks_up_a_published_version(self):
+        reader = self.reader(reload_interval=0)
+        self.assertFalse(reader._loaded)
+        self.assertEqual(reader.query('zzuniqueword', k=1, mode='lexical'), [])
+        self.assertEqual(reader.indexes.ntotal, 5)
+        self.writer.index([{'id': 'new', 'text': 'zzuniqueword', 'metadata': {'team_domain': 'team', 'channel_name': 'beta'}}])
+        self.writer._save_manifest()
+        self.assertEqual(reader.query('zzuniqueword', k=1, mode='lexical')[0]['id'], 'new')
+        self.assertEqual(reader.version, self.writer.version)
+        self.assertEqual(reader.indexes.ntotal, 6)
+
+    def test_reader_keeps_its_version_without_reload(self):
+        reader = self.reader()
+        reader.ensure_loaded()
+        self.writer.index(documents('beta', 1))
+        self.writer._save_manifest()
+        reader.ensure_loaded()
+        self.assertEqual(len(reader.documents), 5)
+
+    def test_reader_refuses_writes(self):
+        with self.assertRaises(RuntimeError):
+            self.reader().index(documents('beta', 1))
+
+if __name__ == '__main__':
+    unittest.main()
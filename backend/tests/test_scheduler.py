@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import asyncio
+import unittest
+
+from pydantic import BaseModel, ValidationError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import AdmissionController, Overloaded, PrioritySemaphore, TokenBucket, UpstreamScheduler
+
+class Route(BaseModel):
+    route: str
+
+class PrioritySemaphoreTest(unittest.IsolatedAsyncioTestCase):
+    async def test_waiters_wake_by_priority_then_arrival(self):
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        order = []
+        async def waiter(name, priority):
+            await semaphore.acquire(priority)
+            order.append(name)
+            semaphore.release()
+        tasks = [asyncio.create_task(waiter(name, priority)) for name, priority in
+                 [('background-1', 1), ('interactive-1', 0), ('background-2', 1), ('interactive-2', 0)]]
+        await asyncio.sleep(0)
+        semaphore.release()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ['interactive-1', 'interactive-2', 'background-1', 'background-2'])
+
+    async def test_cancelled_waiter_does_not_leak_slot(self):
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        task = asyncio.create_task(semaphore.acquire())
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        semaphore.release()
+        await asyncio.wait_for(semaphore.acquire(), 1)
+
+class TokenBucketTest(unittest.IsolatedAsyncioTestCase):
+    async def test_burst_then_rate(self):
+        bucket = TokenBucket(rate_per_second=50, capacity=2)
+        start = time.monotonic()
+        await asyncio.gather(*(bucket.acquire() for _ in range(4)))
+        # Two from the burst, then two more at 50/s.
+        self.assertGreaterEqual(time.monotonic() - start, 0.035)
+
+    async def test_waiters_sleep_concurrently(self):
+        bucket = TokenBucket(rate_per_second=20, capacity=1)
+        await bucket.acquire()
+        waiters = [asyncio.create_task(bucket.acquire()) for _ in range(2)]
+        await asyncio.sleep(0)
+        # Both reservations are taken up front, so nothing queues behind a sleeping waiter.
+        self.assertLess(bucket.tokens, -1)
+        await asyncio.gather(*waiters)
+
+    async def test_cancelled_waiter_refunds_its_token(self):
+        bucket = TokenBucket(rate_per_second=1, capacity=1)
+        await bucket.acquire()
+        task = asyncio.create_task(bucket.acquire())
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.assertGreater(bucket.tokens, -0.5)
+
+class RetryChargingTest(unittest.IsolatedAsyncioTestCase):
+    async def test_every_reask_takes_a_token(self):
+        scheduler = UpstreamScheduler(default={'max_concurrency': 1, 'requests_per_minute': 6, 'burst': 10})
+        _, bucket = scheduler._limits_for('model')
+        attempts = 0
+        async with scheduler.slot('model'):
+            async for attempt in scheduler.retrying('model', attempts=3):
+                with attempt:
+                    attempts += 1
+                    if attempts < 3:
+                        Route.model_validate({})
+        await scheduler.aclose()
+        self.assertEqual(attempts, 3)
+        self.assertAlmostEqual(bucket.tokens, 7, delta=0.5)
+
+    async def test_upstream_errors_are_not_retried(self):
+        scheduler = UpstreamScheduler()
+        attempts = 0
+        with self.assertRaises(RuntimeError):
+            async for attempt in scheduler.retrying('model'):
+                with attempt:
+                    attempts += 1
+                    raise RuntimeError("429")
+        await scheduler.aclose()
+        self.assertEqual(attempts, 1)
+
+    async def test_gives_up_after_attempts(self):
+        scheduler = UpstreamScheduler()
+        with self.assertRaises(ValidationError):
+            async for attempt in scheduler.retrying('model', attempts=2):
+                with attempt:
+                    Route.model_validate({})
+        await scheduler.aclose()
+
+class AdmissionControllerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_sheds_when_queue_is_full(self):
+        admission = AdmissionController(max_concurrent_requests=1, max_queued_requests=1, queue_timeout_seconds=1)
+        await admission.acquire()
+        queued = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        with self.assertRaises(Overloaded):
+            await admission.acquire()
+        admission.release()
+        await queued
+        admission.release()
+
+    async def test_times_out_waiting_for_a_slot(self):
+        admission = AdmissionController(max_concurrent_requests=1, queue_timeout_seconds=0.01)
+        await admission.acquire()
+        with self.assertRaises(Overloaded):
+            await admission.acquire()
+
+    async def test_releaser_frees_the_slot_once(self):
+        admission = AdmissionController(max_concurrent_requests=1, queue_timeout_seconds=0.01)
+        await admission.acquire()
+        release = admission.releaser()
+        release()
+        release()
+        await admission.acquire()
+        with self.assertRaises(Overloaded):
+            await admission.acquire()
+
+if __name__ == '__main__':
+    unittest.main()